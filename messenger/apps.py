@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CommsConfig(AppConfig):
     name = "messenger"
+
+    def ready(self):
+        from messenger import signals  # noqa
+        from messenger.protocol import ProtocolSpec
+
+        if getattr(settings, "RPC_PROTO_SPECS", None):
+            ProtocolSpec.get()
@@ -0,0 +1,120 @@
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec(object):
+    subprotocol = "rtm.json"
+    binary = False
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, content):
+        return json.dumps(content)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise ValueError("No text section for incoming WebSocket frame!")
+        return json.loads(text_data)
+
+    def encode_fields(self, content):
+        return len(content), self.encode(content)[1:-1]
+
+    def encode_field(self, name, encoded):
+        return 1, self.encode(name) + ":" + encoded
+
+    def join_fields(self, *fragments):
+        return "{" + ",".join(data for _, data in fragments if data) + "}"
+
+    def encode_shared(self, key, content):
+        return self.shared(key, lambda: self.encode(content))
+
+    def shared(self, key, build):
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                return data
+        data = build()
+        with self._lock:
+            self._cache[key] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data
+
+
+class OrjsonCodec(JsonCodec):
+    subprotocol = "rtm.orjson"
+
+    def encode(self, content):
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise ValueError("No text section for incoming WebSocket frame!")
+        return orjson.loads(text_data)
+
+
+class MsgpackCodec(JsonCodec):
+    subprotocol = "rtm.msgpack"
+    binary = True
+
+    def encode(self, content):
+        return msgpack.packb(content, use_bin_type=True)
+
+    def encode_fields(self, content):
+        return len(content), self.encode(content)[_map_header_size(len(content)):]
+
+    def encode_field(self, name, encoded):
+        return 1, self.encode(name) + encoded
+
+    def join_fields(self, *fragments):
+        header = msgpack.Packer().pack_map_header(sum(count for count, _ in fragments))
+        return header + b"".join(data for _, data in fragments)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise ValueError("No bytes section for incoming WebSocket frame!")
+        return msgpack.unpackb(bytes_data, raw=False)
+
+
+def _map_header_size(count):
+    if count < 16:
+        return 1
+    return 3 if count < 2 ** 16 else 5
+
+
+default_codec = JsonCodec()
+
+available_codecs = {
+    codec.subprotocol: codec
+    for codec, importable in (
+        (default_codec, True),
+        (OrjsonCodec(), orjson is not None),
+        (MsgpackCodec(), msgpack is not None),
+    )
+    if importable
+}
+
+
+def negotiate(subprotocols):
+    enabled = getattr(settings, "MESSENGER_CODECS", list(available_codecs))
+    for subprotocol in subprotocols[1:]:
+        if subprotocol in enabled and subprotocol in available_codecs:
+            return available_codecs[subprotocol], subprotocol
+    return default_codec, subprotocols[0]
@@ -1,11 +1,31 @@
-import json
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+import asyncio
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, JsonWebsocketConsumer
+from messenger.codecs import default_codec, negotiate
+from messenger.models import RoomMember
 from messenger.presence import Presence
-from messenger.protocol import ProtocolHandlerMixin, Starter
+from messenger.protocol import (
+    AsyncProtocolHandlerMixin,
+    ProtocolHandlerMixin,
+    Starter,
+    message_response,
+    receipt_buffer,
+    room_group,
+)
+from messenger.throttling import (
+    DROP,
+    coalesce_key,
+    frame_command,
+    outbound_buffer,
+    rate_limiter,
+)
 
 
 class RPCConsumer(ProtocolHandlerMixin, JsonWebsocketConsumer):
+    codec = default_codec
+    frame_bucket = None
+
     def connect(self):
         if not self.scope.get("user"):
             self.close()
@@ -13,26 +33,208 @@ class RPCConsumer(ProtocolHandlerMixin, JsonWebsocketConsumer):
             return
 
         self.me = self.scope.get("user")
-        Presence.increment_active_connections(self.me.id)
+        Presence.increment_active_connections(self.me.id, self.channel_name)
 
         async_to_sync(self.channel_layer.group_add)(self.me.id, self.channel_name)
+        self.room_groups = set()
+        room_ids = RoomMember.objects.filter(user=self.me).values_list("room_id", flat=True)
+        for room_id in room_ids:
+            self.room_join({"room_id": room_id})
+
+        limiter = rate_limiter()
+        if limiter is not None:
+            self.frame_bucket = limiter.connection_bucket()
 
-        self.accept(self.scope.get("subprotocols")[0])
+        self.codec, subprotocol = negotiate(self.scope.get("subprotocols"))
+        self.accept(subprotocol)
 
     def disconnect(self, close_code):
 
         if not self.me:
             return
 
-        Presence.decrement_active_connections(self.me.id)
+        Presence.decrement_active_connections(self.me.id, self.channel_name)
+        if receipt_buffer() is not None:
+            receipt_buffer().flush()
 
         async_to_sync(self.channel_layer.group_discard)(self.me.id, self.channel_name)
+        for group in self.room_groups:
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+
+    def receive(self, text_data=None, bytes_data=None, **kwargs):
+        self.receive_json(self.codec.decode(text_data, bytes_data), **kwargs)
 
     def receive_json(self, text_data):
+        if not self.frame_allowed(text_data):
+            return self.send_json(message_response.N3("rate_limited"))
         if not self.message_is_valid(text_data):
             return self.send_json(self.response.N3("not_valid"))
         self._message = text_data
         self.process()
 
+    def frame_allowed(self, text_data):
+        limiter = rate_limiter()
+        if limiter is None or self.frame_bucket is None:
+            return True
+        return limiter.allow(self.me.id, self.frame_bucket, frame_command(text_data))
+
+    def send_json(self, content, close=False):
+        self.send_encoded(self.codec.encode(content), close=close)
+
+    def send_shared(self, key, content):
+        self.send_encoded(self.codec.encode_shared(key, content))
+
+    def send_encoded(self, data, close=False):
+        if self.codec.binary:
+            self.send(bytes_data=data, close=close)
+        else:
+            self.send(text_data=data, close=close)
+
     def chat_message(self, event):
         self.send_json(event)
+
+    def room_join(self, event):
+        group = room_group(event["room_id"])
+        if group not in self.room_groups:
+            self.room_groups.add(group)
+            async_to_sync(self.channel_layer.group_add)(group, self.channel_name)
+
+    def room_message(self, event):
+        data = self._encode_room_message(event)
+        if data is not None:
+            self.send_encoded(data)
+
+    def room_activity(self, event):
+        message = self._room_activity_for_me(event)
+        if message is not None:
+            self.send_shared(event["event_id"], message)
+
+
+class AsyncRPCConsumer(AsyncProtocolHandlerMixin, AsyncJsonWebsocketConsumer):
+    codec = default_codec
+    frame_bucket = None
+    outbound = None
+    outbound_writer = None
+    outbound_closed = False
+
+    async def connect(self):
+        if not self.scope.get("user"):
+            await self.close()
+            self.me = None
+            return
+
+        self.me = self.scope.get("user")
+        self.room_groups = set()
+        _, _, room_ids = await asyncio.gather(
+            sync_to_async(Presence.increment_active_connections)(
+                self.me.id, self.channel_name
+            ),
+            self.channel_layer.group_add(self.me.id, self.channel_name),
+            self._get_room_ids(),
+        )
+        await asyncio.gather(
+            *[self.room_join({"room_id": room_id}) for room_id in room_ids]
+        )
+
+        limiter = rate_limiter()
+        if limiter is not None:
+            self.frame_bucket = limiter.connection_bucket()
+
+        self.codec, subprotocol = negotiate(self.scope.get("subprotocols"))
+        await self.accept(subprotocol)
+
+        self.outbound = outbound_buffer()
+        if self.outbound is not None:
+            self.outbound_ready = asyncio.Event()
+            self.outbound_writer = asyncio.ensure_future(self.drain_outbound())
+
+    async def disconnect(self, close_code):
+
+        if not self.me:
+            return
+
+        if self.outbound_writer is not None:
+            self.outbound_writer.cancel()
+        if receipt_buffer() is not None:
+            await database_sync_to_async(receipt_buffer().flush)()
+        await asyncio.gather(
+            sync_to_async(Presence.decrement_active_connections)(
+                self.me.id, self.channel_name
+            ),
+            self.channel_layer.group_discard(self.me.id, self.channel_name),
+            *[
+                self.channel_layer.group_discard(group, self.channel_name)
+                for group in self.room_groups
+            ]
+        )
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        await self.receive_json(self.codec.decode(text_data, bytes_data), **kwargs)
+
+    async def receive_json(self, text_data):
+        if not self.frame_allowed(text_data):
+            return await self.send_json(message_response.N3("rate_limited"))
+        if not self.message_is_valid(text_data):
+            return await self.send_json(self.response.N3("not_valid"))
+        self._message = text_data
+        await self.process()
+
+    def frame_allowed(self, text_data):
+        limiter = rate_limiter()
+        if limiter is None or self.frame_bucket is None:
+            return True
+        return limiter.allow(self.me.id, self.frame_bucket, frame_command(text_data))
+
+    async def send_json(self, content, close=False):
+        await self.send_encoded(self.codec.encode(content), close=close)
+
+    async def send_shared(self, key, content):
+        await self.send_encoded(self.codec.encode_shared(key, content))
+
+    async def send_encoded(self, data, close=False):
+        if self.codec.binary:
+            await self.send(bytes_data=data, close=close)
+        else:
+            await self.send(text_data=data, close=close)
+
+    async def send_event(self, data, key=None):
+        if self.outbound is None:
+            return await self.send_encoded(data)
+        if self.outbound_closed:
+            return
+        if self.outbound.push(data, key):
+            self.outbound_ready.set()
+        elif self.outbound.policy != DROP:
+            self.outbound_closed = True
+            self.outbound_writer.cancel()
+            await self.close(code=4008)
+
+    async def drain_outbound(self):
+        while True:
+            data = self.outbound.pop()
+            if data is None:
+                self.outbound_ready.clear()
+                await self.outbound_ready.wait()
+                continue
+            await self.send_encoded(data)
+
+    async def chat_message(self, event):
+        await self.send_event(self.codec.encode(event), coalesce_key(event))
+
+    async def room_join(self, event):
+        group = room_group(event["room_id"])
+        if group not in self.room_groups:
+            self.room_groups.add(group)
+            await self.channel_layer.group_add(group, self.channel_name)
+
+    async def room_message(self, event):
+        data = self._encode_room_message(event)
+        if data is not None:
+            await self.send_event(data)
+
+    async def room_activity(self, event):
+        message = self._room_activity_for_me(event)
+        if message is not None:
+            await self.send_event(
+                self.codec.encode_shared(event["event_id"], message), coalesce_key(message)
+            )
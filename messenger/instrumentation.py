@@ -0,0 +1,193 @@
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+HISTOGRAMS = {
+    "messenger_command_seconds": ("Time spent dispatching an RPC command", SECONDS_BUCKETS),
+    "messenger_helper_seconds": ("Time spent in a protocol helper", SECONDS_BUCKETS),
+    "messenger_helper_queries": ("DB queries issued by a protocol helper", SIZE_BUCKETS),
+    "messenger_fanout_size": ("Recipients addressed by a single command", SIZE_BUCKETS),
+    "messenger_write_behind_lag_seconds": (
+        "Time from queueing a message to committing it", SECONDS_BUCKETS
+    ),
+    "messenger_write_behind_batch_size": ("Messages written per batch", SIZE_BUCKETS),
+}
+COUNTERS = {
+    "messenger_errors_total": "Commands that failed with an unexpected error",
+    "messenger_rate_limited_total": "Frames rejected by a rate limiter",
+    "messenger_outbound_coalesced_total": "Outbound frames merged into a pending frame",
+    "messenger_outbound_overflow_total": "Outbound frames that hit a full buffer",
+    "messenger_write_behind_overflow_total": "Sends that flushed the queue because it was full",
+    "messenger_write_behind_dead_letter_total": "Sends dropped after repeated write failures",
+    "messenger_activity_coalesced_total": "Activity events suppressed inside the throttle window",
+}
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        buckets = HISTOGRAMS[name][1]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @contextmanager
+    def queries(self, name, **labels):
+        count = [0]
+
+        def counter(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        try:
+            with connection.execute_wrapper(counter):
+                yield
+        finally:
+            self.observe(name, count[0], **labels)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        with self._lock:
+            histograms = {key: (list(v[0]), v[1], v[2]) for key, v in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        for name, (description, buckets) in HISTOGRAMS.items():
+            series = sorted(
+                (labels, value) for (metric, labels), value in histograms.items()
+                if metric == name
+            )
+            if not series:
+                continue
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} histogram".format(name))
+            for labels, (counts, total, count) in series:
+                for bound, bucket in zip(buckets, counts):
+                    lines.append(
+                        "{}_bucket{} {}".format(name, _labels(labels, le=bound), bucket)
+                    )
+                lines.append("{}_bucket{} {}".format(name, _labels(labels, le="+Inf"), count))
+                lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+                lines.append("{}_count{} {}".format(name, _labels(labels), count))
+        for name, description in COUNTERS.items():
+            series = sorted(
+                (labels, value) for (metric, labels), value in counters.items()
+                if metric == name
+            )
+            if not series:
+                continue
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} counter".format(name))
+            for labels, value in series:
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value) for key, value in pairs) + "}"
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+
+def metrics():
+    global _registry, _registry_pid
+    if not getattr(settings, "MESSENGER_METRICS", False):
+        return None
+    pid = os.getpid()
+    if _registry is None or _registry_pid != pid:
+        with _registry_lock:
+            if _registry is None or _registry_pid != pid:
+                _registry_pid = pid
+                _registry = import_string(
+                    getattr(
+                        settings,
+                        "MESSENGER_METRICS_BACKEND",
+                        "messenger.instrumentation.MetricsRegistry",
+                    )
+                )()
+    return _registry
+
+
+def instrument(helper, db=False):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            registry = metrics()
+            if registry is None:
+                return func(*args, **kwargs)
+            with registry.timer("messenger_helper_seconds", helper=helper):
+                if not db:
+                    return func(*args, **kwargs)
+                with registry.queries("messenger_helper_queries", helper=helper):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe(name, value, **labels):
+    registry = metrics()
+    if registry is not None:
+        registry.observe(name, value, **labels)
+
+
+def record_fanout(command, size):
+    observe("messenger_fanout_size", size, command=command)
+
+
+def increment(name, **labels):
+    registry = metrics()
+    if registry is not None:
+        registry.inc(name, **labels)
+
+
+def record_error(command, error):
+    logger.exception(f"Command {command} failed: {error}")
+    increment("messenger_errors_total", command=command)
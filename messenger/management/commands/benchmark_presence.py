@@ -0,0 +1,132 @@
+import os
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from redis import Connection, ConnectionPool, Redis
+
+from messenger.presence import Presence
+from messenger.sharding import HashRing
+
+
+class CountingConnection(Connection):
+    round_trips = 0
+    connections = 0
+
+    def connect(self):
+        if not self._sock:
+            CountingConnection.connections += 1
+        return super().connect()
+
+    def send_packed_command(self, *args, **kwargs):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(*args, **kwargs)
+
+
+def counting_pool():
+    redis_settings = urlparse(settings.REDIS_URL)
+    return ConnectionPool(
+        host=redis_settings.hostname,
+        port=redis_settings.port,
+        password=redis_settings.password,
+        decode_responses=True,
+        connection_class=CountingConnection,
+    )
+
+
+class LegacyPresence(object):
+    @staticmethod
+    @contextmanager
+    def _connect():
+        pool = counting_pool()
+        try:
+            yield Redis(connection_pool=pool)
+        finally:
+            pool.disconnect()
+
+    @staticmethod
+    def decrement_active_connections(user, channel_name=None):
+        with LegacyPresence._connect() as redis:
+            try:
+                value = int(redis.get(user))
+                assert value > 0
+            except Exception:
+                redis.set(user, 0, ex=settings.WS_KEY_EXPIRE)
+                return int(redis.get(user))
+            return redis.decr(user)
+
+    @staticmethod
+    def increment_active_connections(user, channel_name=None):
+        with LegacyPresence._connect() as redis:
+            redis.incr(user)
+            redis.expire(user, settings.WS_KEY_EXPIRE)
+            return int(redis.get(user))
+
+    @staticmethod
+    def is_online(user):
+        with LegacyPresence._connect() as redis:
+            try:
+                return int(redis.get(user)) > 0
+            except Exception:
+                return False
+
+
+class Command(BaseCommand):
+    help = "Measure Redis round-trips and latency per Presence call"
+
+    OPERATIONS = (
+        "increment_active_connections",
+        "is_online",
+        "decrement_active_connections",
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=1000)
+        parser.add_argument("--key-prefix", default="benchmark_presence:")
+
+    def handle(self, *args, **options):
+        saved = Presence._pools, Presence._pools_pid, Presence._ring, Presence._executor
+        Presence._pools = [counting_pool()]
+        Presence._ring = HashRing([settings.REDIS_URL])
+        Presence._executor = None
+        Presence._pools_pid = os.getpid()
+        try:
+            for label, backend in (("before", LegacyPresence), ("after", Presence)):
+                for operation in self.OPERATIONS:
+                    self._report(label, operation, backend, options)
+        finally:
+            Presence._pools[0].disconnect()
+            Presence._pools, Presence._pools_pid, Presence._ring, Presence._executor = saved
+
+    def _report(self, label, operation, backend, options):
+        method = getattr(backend, operation)
+        iterations = options["iterations"]
+        keys = [
+            "{}{}".format(options["key_prefix"], i) for i in range(iterations)
+        ]
+        CountingConnection.round_trips = 0
+        CountingConnection.connections = 0
+        timings = []
+
+        for key in keys:
+            started = time.perf_counter()
+            if operation == "is_online":
+                method(key)
+            else:
+                method(key, "benchmark.{}".format(key))
+            timings.append(time.perf_counter() - started)
+
+        timings.sort()
+        self.stdout.write(
+            "{:<7} {:<29} round-trips/call={:.2f} connections/call={:.2f} "
+            "mean={:.1f}us p99={:.1f}us".format(
+                label,
+                operation,
+                CountingConnection.round_trips / iterations,
+                CountingConnection.connections / iterations,
+                sum(timings) / iterations * 1e6,
+                timings[int(iterations * 0.99) - 1] * 1e6,
+            )
+        )
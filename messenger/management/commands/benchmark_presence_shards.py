@@ -0,0 +1,77 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from messenger.presence import Presence
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure Presence throughput with 1..N Redis shards. Start one "
+        "redis-server per shard locally (e.g. ports 6380-6383) and pass them "
+        "with --urls"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--urls",
+            help="Comma-separated Redis URLs, defaults to PRESENCE_REDIS_URLS",
+        )
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument("--batch", type=int, default=100)
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--key-prefix", default="benchmark_shards:")
+
+    def handle(self, *args, **options):
+        if options["urls"]:
+            urls = options["urls"].split(",")
+        else:
+            urls = getattr(settings, "PRESENCE_REDIS_URLS", None) or [settings.REDIS_URL]
+        if len(set(urls)) != len(urls):
+            raise CommandError("Shard URLs must be distinct")
+
+        users = [
+            "{}{}".format(options["key_prefix"], i) for i in range(options["users"])
+        ]
+        batches = [
+            users[i:i + options["batch"]] for i in range(0, len(users), options["batch"])
+        ]
+        for shards in range(1, len(urls) + 1):
+            with override_settings(PRESENCE_REDIS_URLS=urls[:shards], PRESENCE_CACHE_ENABLED=False):
+                Presence._pools = None
+                try:
+                    self._run(shards, users, batches, options["threads"])
+                finally:
+                    Presence._pools = None
+
+    def _run(self, shards, users, batches, threads):
+        with ThreadPoolExecutor(threads) as executor:
+            connect = self._timed(
+                executor,
+                lambda user: Presence.increment_active_connections(user, "benchmark." + user),
+                users,
+            )
+            lookup = self._timed(executor, Presence.online_many, batches)
+            disconnect = self._timed(
+                executor,
+                lambda user: Presence.decrement_active_connections(user, "benchmark." + user),
+                users,
+            )
+        self.stdout.write(
+            "shards={:<2} connect={:>9.0f}/s online_many={:>9.0f} users/s "
+            "disconnect={:>9.0f}/s".format(
+                shards,
+                len(users) / connect,
+                len(users) / lookup,
+                len(users) / disconnect,
+            )
+        )
+
+    @staticmethod
+    def _timed(executor, func, items):
+        started = time.perf_counter()
+        list(executor.map(func, items))
+        return time.perf_counter() - started
@@ -0,0 +1,277 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from unittest.mock import patch
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends import utils as backend_utils
+from django.test.utils import override_settings, setup_test_environment
+
+from comms.models import Message
+from custom_auth.factories import CustomUserFactory
+from fakeredis import FakeServer, FakeStrictRedis
+from messenger import membership
+from messenger.consumers import AsyncRPCConsumer, RPCConsumer
+from messenger.models import Room, RoomInbox, RoomMember
+from messenger.presence import Presence
+
+SENTINEL = {"command": "PING"}
+NOT_VALID = "Message could not pass validation"
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        counter = self
+        execute = backend_utils.CursorWrapper.execute
+        executemany = backend_utils.CursorWrapper.executemany
+
+        def counted_execute(self, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return execute(self, *args, **kwargs)
+
+        def counted_executemany(self, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return executemany(self, *args, **kwargs)
+
+        self._patches = [
+            patch.object(backend_utils.CursorWrapper, "execute", counted_execute),
+            patch.object(backend_utils.CursorWrapper, "executemany", counted_executemany),
+        ]
+        for patcher in self._patches:
+            patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for patcher in self._patches:
+            patcher.stop()
+
+
+class Client(object):
+    def __init__(self, user, consumer_class):
+        self.user = user
+        self.communicator = WebsocketCommunicator(
+            lambda scope: consumer_class(dict(scope, user=user)),
+            "/ws/chat/",
+            subprotocols=["benchmark-token"],
+        )
+        self.rooms = []
+        self.inbox = []
+        self.acks = 0
+        self.errors = 0
+        self.frames = 0
+        self._acked = asyncio.Event()
+        self._reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError("Connection refused for user {}".format(self.user.id))
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        while True:
+            event = json.loads((await self.communicator.output_queue.get())["text"])
+            self.frames += 1
+            if event.get("id") == "N0" and event["message_data"].get("recipient") == self.user.id:
+                self.inbox.append(event["message_id"])
+            if "error" in event:
+                if event["error"] == NOT_VALID:
+                    self.acks += 1
+                    self._acked.set()
+                else:
+                    self.errors += 1
+
+    async def call(self, frame):
+        self._acked.clear()
+        acks = self.acks
+        started = time.perf_counter()
+        await self.communicator.send_json_to(frame)
+        await self.communicator.send_json_to(SENTINEL)
+        while self.acks <= acks:
+            await self._acked.wait()
+            self._acked.clear()
+        return time.perf_counter() - started
+
+    async def disconnect(self):
+        self._reader.cancel()
+        await self.communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive RPCConsumer over WebsocketCommunicator with an in-memory channel "
+        "layer and fakeredis, and report latency, throughput and DB queries"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--room-size", type=int, default=2)
+        parser.add_argument("--rooms-per-user", type=int, default=3)
+        parser.add_argument("--frames", type=int, default=5000)
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--mix", default="C0=5,C1=60,C2=20,C3=15")
+        parser.add_argument("--consumer", choices=("sync", "async"), default="async")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write JSON results to this file")
+        parser.add_argument("--keepdb", action="store_true")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, keepdb=options["keepdb"]
+        )
+        redis_server = FakeServer()
+
+        def fake_redis():
+            return FakeStrictRedis(server=redis_server, decode_responses=True)
+
+        try:
+            with override_settings(
+                CHANNEL_LAYERS={
+                    "default": {
+                        "BACKEND": "channels.layers.InMemoryChannelLayer",
+                        "CONFIG": {"capacity": 100000},
+                    }
+                }
+            ), patch.object(
+                Presence, "_client", side_effect=lambda index: fake_redis()
+            ), patch.object(membership, "_connect", side_effect=fake_redis):
+                results = asyncio.get_event_loop().run_until_complete(
+                    self._run(options)
+                )
+        finally:
+            connection.creation.destroy_test_db(
+                old_name, verbosity=0, keepdb=options["keepdb"]
+            )
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as results_file:
+                results_file.write(output)
+        self.stdout.write(output)
+
+    def _populate(self, options, rng):
+        users = [CustomUserFactory() for _ in range(options["users"])]
+        rooms = []
+        for _ in range(options["users"] * options["rooms_per_user"] // options["room_size"]):
+            members = rng.sample(users, options["room_size"])
+            room = Room.objects.create(
+                active=True,
+                members_key=Room.members_key_for(user.id for user in members),
+                participants=[
+                    {
+                        "user_id": user.id,
+                        "first_name": user.first_name,
+                        "last_name": user.last_name,
+                    }
+                    for user in members
+                ],
+            )
+            RoomMember.objects.bulk_create([RoomMember(room=room, user=user) for user in members])
+            RoomInbox.objects.bulk_create([RoomInbox(room=room, user=user) for user in members])
+            rooms.append((room, members))
+        return users, rooms
+
+    async def _run(self, options):
+        rng = random.Random(options["seed"])
+        users, rooms = self._populate(options, rng)
+        consumer_class = AsyncRPCConsumer if options["consumer"] == "async" else RPCConsumer
+        clients = {user.id: Client(user, consumer_class) for user in users}
+        for room, members in rooms:
+            for user in members:
+                clients[user.id].rooms.append(room.id)
+
+        await asyncio.gather(*[client.connect() for client in clients.values()])
+        online = Presence.online_many(user.id for user in users)
+        if len(online) != len(users):
+            raise CommandError(
+                "Only {} of {} connected users are online".format(len(online), len(users))
+            )
+
+        mix = [entry.split("=") for entry in options["mix"].split(",")]
+        commands, weights = zip(*[(command, float(weight)) for command, weight in mix])
+        latencies = {command: [] for command in commands}
+        frames = iter(range(options["frames"]))
+        busy = set()
+
+        async def worker():
+            for _ in frames:
+                client = rng.choice([c for c in clients.values() if c.user.id not in busy])
+                busy.add(client.user.id)
+                try:
+                    command = rng.choices(commands, weights=weights)[0]
+                    frame = self._frame(command, client, users, rng)
+                    if frame is None:
+                        continue
+                    latencies[command].append(await client.call(frame))
+                finally:
+                    busy.discard(client.user.id)
+
+        with QueryCounter() as queries:
+            started = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(options["concurrency"])])
+            elapsed = time.perf_counter() - started
+
+        await asyncio.gather(*[client.disconnect() for client in clients.values()])
+
+        sent = sum(len(samples) for samples in latencies.values())
+        return {
+            "consumer": options["consumer"],
+            "users": options["users"],
+            "room_size": options["room_size"],
+            "rooms": len(rooms),
+            "concurrency": options["concurrency"],
+            "frames": sent,
+            "elapsed_s": elapsed,
+            "frames_per_sec": sent / elapsed if elapsed else None,
+            "db_queries": queries.count,
+            "db_queries_per_frame": queries.count / sent if sent else None,
+            "frames_delivered": sum(client.frames for client in clients.values()),
+            "errors": sum(client.errors for client in clients.values()),
+            "messages_persisted": Message.objects.count(),
+            "latency_ms": {
+                command: self._percentiles(samples)
+                for command, samples in latencies.items()
+            },
+        }
+
+    @staticmethod
+    def _frame(command, client, users, rng):
+        if command == "C0":
+            return {"command": "C0", "uids": [rng.choice(users).id]}
+        if command == "C1" and client.rooms:
+            return {
+                "command": "C1",
+                "room_id": rng.choice(client.rooms),
+                "message_data": "benchmark message",
+            }
+        if command == "C6" and client.rooms:
+            return {"command": "C6", "room_id": rng.choice(client.rooms), "activity": "typing"}
+        if command in ("C2", "C3") and client.inbox:
+            return {"command": command, "message_id": client.inbox.pop(0)}
+        if command in ("C4", "C5") and client.inbox:
+            message_ids, client.inbox = client.inbox[:50], client.inbox[50:]
+            return {"command": command, "message_ids": message_ids}
+        return None
+
+    @staticmethod
+    def _percentiles(samples):
+        if not samples:
+            return {"count": 0, "p50": None, "p99": None}
+        samples = sorted(samples)
+        return {
+            "count": len(samples),
+            "p50": samples[int(len(samples) * 0.50)] * 1000,
+            "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            "max": samples[-1] * 1000,
+        }
@@ -0,0 +1,83 @@
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from messenger.protocol import MessageValidator
+
+
+class LegacyMessageValidator(object):
+    _DATA_TYPES = {"string": str, "array": list, "integer": int, "null": None}
+
+    def __init__(self, text):
+        self.text = text
+        self.commands = settings.RPC_PROTO_SPECS.get("commands")
+
+    @property
+    def is_valid(self):
+        if not self.text.get("command", False):
+            return False
+        if self.text["command"] not in [command["id"] for command in self.commands]:
+            return False
+        for command in self.commands:
+            if command["id"] == self.text["command"]:
+                self.message_params = self.text.copy()
+                self.message_params.pop("command")
+                self.params = command["params"]
+        param_ids = [param["id"] for param in self.params]
+        param_types = {p["id"]: self._DATA_TYPES[p["type"]] for p in self.params}
+        return all(
+            [
+                all([self.text.get(pid, False) for pid in param_ids]),
+                all(isinstance(self.text.get(pid), param_types[pid]) for pid in param_ids),
+                not any(
+                    isinstance(value, (str, list)) and len(value) == 0
+                    for value in self.message_params.values()
+                ),
+            ]
+        )
+
+
+class Command(BaseCommand):
+    help = "Measure protocol validation throughput on a mix of C0-C3 frames"
+
+    FRAMES = (
+        (40, {"command": "C1", "room_id": "aB3dE5gH", "message_data": "hello there"}),
+        (25, {"command": "C2", "message_id": "kL9mN0pQ"}),
+        (25, {"command": "C3", "message_id": "kL9mN0pQ"}),
+        (5, {"command": "C0", "uids": [17, 42, 99]}),
+        (3, {"command": "C1", "room_id": "aB3dE5gH", "message_data": ""}),
+        (2, {"command": "C2", "non": "valid"}),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--frames", type=int, default=200000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        weights, frames = zip(*self.FRAMES)
+        mix = rng.choices(frames, weights=weights, k=options["frames"])
+
+        for label, validate in (
+            ("before", self._legacy),
+            ("after", self._compiled),
+        ):
+            started = time.perf_counter()
+            for frame in mix:
+                validate(frame)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                "{:<7} frames={} elapsed={:.3f}s throughput={:.0f} frames/sec".format(
+                    label, len(mix), elapsed, len(mix) / elapsed
+                )
+            )
+
+    @staticmethod
+    def _legacy(frame):
+        return LegacyMessageValidator(frame).is_valid
+
+    @staticmethod
+    def _compiled(frame):
+        return MessageValidator(frame).is_valid
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from redis import Redis
+
+from messenger.presence_cache import InvalidationListener
+
+logger = logging.getLogger(__name__)
+
+
+class RoomMembership(object):
+    __slots__ = ("room_id", "participants", "member_ids")
+
+    def __init__(self, room_id, participants):
+        self.room_id = room_id
+        self.participants = participants
+        self.member_ids = frozenset(
+            participant["user_id"] for participant in participants
+        )
+
+    def recipients(self, sender_id):
+        return [
+            participant["user_id"]
+            for participant in self.participants
+            if participant["user_id"] != sender_id
+        ]
+
+
+class MembershipCache(object):
+    KEY = "membership:{}"
+
+    def __init__(self, ttl, max_size, channel, connect, shared=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.channel = channel
+        self.connect = connect
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, room_id):
+        key = str(room_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+
+        if self.shared:
+            try:
+                data = self.connect().get(self.KEY.format(key))
+            except Exception:
+                data = None
+            if data is not None:
+                membership = RoomMembership(room_id, json.loads(data))
+                self._store(membership, generation)
+                return membership
+        return None
+
+    def set(self, room_id, participants, generation=None):
+        membership = RoomMembership(room_id, participants)
+        if self._store(membership, generation) and self.shared:
+            try:
+                self.connect().set(
+                    self.KEY.format(room_id), json.dumps(participants), ex=self.ttl
+                )
+            except Exception:
+                pass
+        return membership
+
+    def _store(self, membership, generation):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            key = str(membership.room_id)
+            self._entries[key] = (membership, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return True
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(str(room_id), None)
+
+    def delete(self, room_id):
+        self.invalidate(room_id)
+        try:
+            pipe = self.connect().pipeline()
+            if self.shared:
+                pipe.delete(self.KEY.format(room_id))
+            pipe.publish(self.channel, room_id)
+            pipe.execute()
+        except Exception as error:
+            logger.error(f"Membership invalidation for room {room_id} failed: {error}")
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+_redis = None
+
+
+def _connect():
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def membership_cache():
+    global _cache, _cache_pid
+    if not getattr(settings, "MESSENGER_MEMBERSHIP_CACHE", False):
+        return None
+    pid = os.getpid()
+    if _cache is None or _cache_pid != pid:
+        with _cache_lock:
+            if _cache is None or _cache_pid != pid:
+                _cache_pid = pid
+                _cache = MembershipCache(
+                    ttl=getattr(settings, "MESSENGER_MEMBERSHIP_CACHE_TTL", 300),
+                    max_size=getattr(settings, "MESSENGER_MEMBERSHIP_CACHE_MAX_SIZE", 10000),
+                    channel=getattr(settings, "MESSENGER_MEMBERSHIP_CHANNEL", "membership"),
+                    connect=_connect,
+                    shared=getattr(settings, "MESSENGER_MEMBERSHIP_CACHE_REDIS", False),
+                )
+                InvalidationListener(_connect, _cache.channel, _cache).start()
+    return _cache
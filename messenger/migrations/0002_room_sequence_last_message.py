@@ -0,0 +1,37 @@
+# Generated by Django 2.1.9 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_room_heads(apps, schema_editor):
+    Room = apps.get_model("messenger", "Room")
+    Message = apps.get_model("comms", "Message")
+
+    for room in Room.objects.all().iterator():
+        messages = Message.objects.filter(context__contains={"room": room.id})
+        room.last_message = messages.order_by("created_on").last()
+        room.sequence = messages.count()
+        room.save(update_fields=["last_message", "sequence"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '__first__'),
+        ('messenger', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms.Message'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='sequence',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_room_heads, migrations.RunPython.noop),
+    ]
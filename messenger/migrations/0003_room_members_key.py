@@ -0,0 +1,32 @@
+# Generated by Django 2.1.9 on 2026-10-18 10:40
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def backfill_members_keys(apps, schema_editor):
+    Room = apps.get_model("messenger", "Room")
+    RoomMember = apps.get_model("messenger", "RoomMember")
+
+    for room in Room.objects.all().iterator():
+        user_ids = RoomMember.objects.filter(room_id=room.id).values_list("user_id", flat=True)
+        canonical = ",".join(sorted({str(user_id) for user_id in user_ids}))
+        room.members_key = hashlib.sha256(canonical.encode()).hexdigest()
+        room.save(update_fields=["members_key"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0002_room_sequence_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='members_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_members_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 2.1.9 on 2026-10-18 11:05
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+from django.db.models import Q
+import django.db.models.deletion
+
+
+def backfill_inboxes(apps, schema_editor):
+    Room = apps.get_model("messenger", "Room")
+    RoomMember = apps.get_model("messenger", "RoomMember")
+    RoomInbox = apps.get_model("messenger", "RoomInbox")
+    Message = apps.get_model("comms", "Message")
+
+    for room in Room.objects.all().iterator():
+        members = RoomMember.objects.filter(room_id=room.id).select_related("user")
+        room.participants = [
+            {
+                "user_id": member.user.id,
+                "first_name": member.user.first_name,
+                "last_name": member.user.last_name,
+            }
+            for member in members
+        ]
+        room.save(update_fields=["participants"])
+
+        inboxes = []
+        for member in members:
+            last_message = (
+                Message.objects.filter(
+                    Q(sender_id=member.user_id) | Q(recipient_id=member.user_id),
+                    context__contains={"room": room.id},
+                )
+                .order_by("created_on")
+                .last()
+            )
+            inboxes.append(
+                RoomInbox(
+                    room_id=room.id,
+                    user_id=member.user_id,
+                    last_message=last_message,
+                    last_activity=last_message.created_on if last_message else None,
+                )
+            )
+        RoomInbox.objects.bulk_create(inboxes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('comms', '__first__'),
+        ('messenger', '0003_room_members_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='participants',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list),
+        ),
+        migrations.CreateModel(
+            name='RoomInbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_on', models.DateTimeField(auto_now=True, db_index=True)),
+                ('last_activity', models.DateTimeField(blank=True, null=True)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms.Message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='messenger.Room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='roominbox',
+            index=models.Index(fields=['user', '-last_activity'], name='messenger_inbox_user_activity'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='roominbox',
+            unique_together={('user', 'room')},
+        ),
+        migrations.RunPython(backfill_inboxes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 2.1.9 on 2026-10-18 14:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 2000
+
+
+def _is_primary(message, sends):
+    # Legacy C1 saved one copy per recipient back to back, without a
+    # "primary" flag.  A copy starts a new send unless it repeats the
+    # previous copy's content for a recipient that send has not reached yet.
+    if "primary" in message.context:
+        return message.context["primary"]
+    key = (str(message.context["room"]), message.sender_id)
+    send = sends.get(key)
+    if (
+        send is not None
+        and send[0] == message.content
+        and message.recipient_id not in send[1]
+    ):
+        send[1].add(message.recipient_id)
+        return False
+    sends[key] = (message.content, {message.recipient_id})
+    return True
+
+
+def backfill_room_messages(apps, schema_editor):
+    Room = apps.get_model("messenger", "Room")
+    RoomMessage = apps.get_model("messenger", "RoomMessage")
+    Message = apps.get_model("comms", "Message")
+
+    room_ids = set(str(room_id) for room_id in Room.objects.values_list("id", flat=True))
+    batch = []
+    sends = {}
+    messages = Message.objects.filter(context__has_key="room").order_by("created_on", "id")
+    for message in messages.iterator():
+        room_id = message.context["room"]
+        if str(room_id) not in room_ids:
+            continue
+        batch.append(
+            RoomMessage(
+                message_id=message.id,
+                room_id=room_id,
+                sender_id=message.sender_id,
+                recipient_id=message.recipient_id,
+                primary=_is_primary(message, sends),
+                sequence=message.context.get("seq"),
+                created_on=message.created_on,
+            )
+        )
+        if len(batch) >= BATCH_SIZE:
+            RoomMessage.objects.bulk_create(batch)
+            batch = []
+    RoomMessage.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('comms', '__first__'),
+        ('messenger', '0004_roominbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomMessage',
+            fields=[
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='room_link', serialize=False, to='comms.Message')),
+                ('primary', models.BooleanField(default=True)),
+                ('sequence', models.BigIntegerField(null=True)),
+                ('created_on', models.DateTimeField()),
+                ('recipient', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='messenger.Room')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='roommessage',
+            index=models.Index(fields=['room', '-created_on'], name='messenger_roommsg_created'),
+        ),
+        migrations.AddIndex(
+            model_name='roommessage',
+            index=models.Index(fields=['room', 'sequence'], name='messenger_roommsg_sequence'),
+        ),
+        migrations.RunPython(backfill_room_messages, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+import hashlib
+from django.contrib.postgres.fields import JSONField
 from django.db import models
 from custom_auth.models import CustomUser
 from custom_base_model.models import CustomBaseModel
@@ -7,8 +9,112 @@ from custom_obscure_id.fields import ObscureIdField
 class Room(CustomBaseModel):
     id = ObscureIdField(primary_key=True)
     active = models.BooleanField(default=False)
+    sequence = models.BigIntegerField(default=0)
+    last_message = models.ForeignKey(
+        "comms.Message",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+    members_key = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    participants = JSONField(default=list, blank=True)
+
+    @staticmethod
+    def members_key_for(user_ids):
+        canonical = ",".join(sorted({str(user_id) for user_id in user_ids}))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def refresh_members_key(self):
+        self.members_key = self.members_key_for(
+            self.roommember_set.values_list("user_id", flat=True)
+        )
+        self.save(update_fields=["members_key"])
+
+    def refresh_members(self):
+        users = [
+            member.user
+            for member in self.roommember_set.select_related("user").order_by("id")
+        ]
+        self.participants = [
+            {"user_id": user.id, "first_name": user.first_name, "last_name": user.last_name}
+            for user in users
+        ]
+        self.members_key = self.members_key_for(user.id for user in users)
+        self.save(update_fields=["participants", "members_key"])
 
 
 class RoomMember(CustomBaseModel):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
+
+
+class RoomInbox(CustomBaseModel):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    last_message = models.ForeignKey(
+        "comms.Message",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+    last_activity = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def advance(cls, room_id, messages, activity):
+        cls.objects.filter(room_id=room_id).update(
+            last_message=models.Case(
+                *[
+                    models.When(user_id=message.recipient_id, then=models.Value(message.id))
+                    for message in messages
+                ],
+                default=models.Value(messages[-1].id)
+            ),
+            last_activity=activity,
+        )
+
+    class Meta:
+        unique_together = ("user", "room")
+        indexes = [
+            models.Index(
+                fields=["user", "-last_activity"], name="messenger_inbox_user_activity"
+            )
+        ]
+
+
+class RoomMessage(models.Model):
+    message = models.OneToOneField(
+        "comms.Message",
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name="room_link",
+    )
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="+")
+    recipient = models.ForeignKey(
+        CustomUser, null=True, on_delete=models.CASCADE, related_name="+"
+    )
+    primary = models.BooleanField(default=True)
+    sequence = models.BigIntegerField(null=True)
+    created_on = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["room", "-created_on"], name="messenger_roommsg_created"
+            ),
+            models.Index(fields=["room", "sequence"], name="messenger_roommsg_sequence"),
+        ]
+
+    @classmethod
+    def for_message(cls, message):
+        return cls(
+            message=message,
+            room_id=message.context["room"],
+            sender_id=message.sender_id,
+            recipient_id=message.recipient_id,
+            primary=message.context.get("primary", True),
+            sequence=message.context.get("seq"),
+            created_on=message.created_on,
+        )
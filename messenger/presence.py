@@ -1,52 +1,259 @@
-from redis import Redis
+import functools
+import logging
+import os
+import threading
+import time
+from redis import ConnectionPool, Redis
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from django.conf import settings
+from messenger.instrumentation import instrument
+from messenger.presence_cache import PresenceCache, InvalidationListener
+from messenger.sharding import HashRing
+
+logger = logging.getLogger(__name__)
 
 
 class Presence(object):
+    KEY = "presence:{}"
+    _pools = None
+    _pools_pid = None
+    _pools_lock = threading.Lock()
+    _ring = None
+    _executor = None
+    _cache = None
+    _cache_pid = None
+    _cache_lock = threading.Lock()
+    _local = {}
+    _local_lock = threading.Lock()
+    _heartbeat_pid = None
+
+    @staticmethod
+    def _urls():
+        return getattr(settings, "PRESENCE_REDIS_URLS", None) or [settings.REDIS_URL]
+
+    @classmethod
+    def _get_pools(cls):
+        pid = os.getpid()
+        if cls._pools is None or cls._pools_pid != pid:
+            with cls._pools_lock:
+                if cls._pools is None or cls._pools_pid != pid:
+                    urls = cls._urls()
+                    pools = []
+                    for url in urls:
+                        redis_settings = urlparse(url)
+                        pools.append(
+                            ConnectionPool(
+                                host=redis_settings.hostname,
+                                port=redis_settings.port,
+                                password=redis_settings.password,
+                                decode_responses=True,
+                            )
+                        )
+                    cls._ring = HashRing(urls)
+                    cls._executor = (
+                        ThreadPoolExecutor(len(urls), thread_name_prefix="presence-shard")
+                        if len(urls) > 1
+                        else None
+                    )
+                    cls._pools = pools
+                    cls._pools_pid = pid
+        return cls._pools
+
+    @classmethod
+    def _shard(cls, user):
+        cls._get_pools()
+        return cls._ring.index_for(user)
+
+    @classmethod
+    def _client(cls, index):
+        return Redis(connection_pool=cls._get_pools()[index])
+
+    @classmethod
+    def _connect(cls, user=None):
+        return cls._client(0 if user is None else cls._shard(user))
+
+    @classmethod
+    def _partition(cls, users):
+        cls._get_pools()
+        return cls._ring.partition(users)
+
+    @classmethod
+    def _map_shards(cls, func, shards):
+        if len(shards) <= 1 or cls._executor is None:
+            return [func(keys) for keys in shards.values()]
+        return list(cls._executor.map(func, shards.values()))
+
     @classmethod
-    def _connect(cls):
-        redis_settings = urlparse(settings.REDIS_URL)
-        return Redis(
-            host=redis_settings.hostname,
-            port=redis_settings.port,
-            password=redis_settings.password,
-            decode_responses=True,
-        )
+    def cache(cls):
+        if not getattr(settings, "PRESENCE_CACHE_ENABLED", False):
+            return None
+        pid = os.getpid()
+        if cls._cache is None or cls._cache_pid != pid:
+            with cls._cache_lock:
+                if cls._cache is None or cls._cache_pid != pid:
+                    cls._cache = PresenceCache(
+                        ttl=getattr(settings, "PRESENCE_CACHE_TTL", 2),
+                        max_size=getattr(settings, "PRESENCE_CACHE_MAX_SIZE", 10000),
+                    )
+                    cls._cache_pid = pid
+                    for index in range(len(cls._get_pools())):
+                        InvalidationListener(
+                            functools.partial(cls._client, index),
+                            Presence._channel(),
+                            cls._cache,
+                        ).start()
+        return cls._cache
 
     @staticmethod
-    def decrement_active_connections(user):
-        redis = Presence._connect()
-        try:
-            value = int(redis.get(user))
-            assert value > 0
-        except Exception:
-            redis.set(user, 0, ex=settings.WS_KEY_EXPIRE)
-            return int(redis.get(user))
+    def _channel():
+        return getattr(settings, "PRESENCE_CHANNEL", "presence")
 
-        try:
-            return redis.decr(user)
-        except Exception:
-            redis.delete(user)
-            redis.set(user, 0, ex=settings.WS_KEY_EXPIRE)
-            return int(redis.get(user))
+    @staticmethod
+    def _publish_change(pipe, user):
+        if Presence.cache() is not None:
+            pipe.publish(Presence._channel(), user)
+
+    @staticmethod
+    def _invalidate(user):
+        cache = Presence.cache()
+        if cache is not None:
+            cache.invalidate(user)
+
+    @staticmethod
+    def _key(user):
+        return Presence.KEY.format(user)
+
+    @staticmethod
+    def _ttl():
+        return getattr(settings, "PRESENCE_CONNECTION_TTL", 90)
+
+    @classmethod
+    def _track(cls, user, channel_name):
+        pid = os.getpid()
+        with cls._local_lock:
+            if cls._heartbeat_pid != pid:
+                cls._local = {}
+                cls._heartbeat_pid = pid
+                threading.Thread(
+                    target=cls._run_heartbeat, name="presence-heartbeat", daemon=True
+                ).start()
+            cls._local[channel_name] = user
+
+    @classmethod
+    def _untrack(cls, channel_name):
+        with cls._local_lock:
+            cls._local.pop(channel_name, None)
+
+    @classmethod
+    def _run_heartbeat(cls):
+        while True:
+            time.sleep(getattr(settings, "PRESENCE_HEARTBEAT_INTERVAL", 30))
+            try:
+                cls.heartbeat()
+            except Exception as error:
+                logger.error(f"Presence heartbeat failed: {error}")
 
     @staticmethod
-    def increment_active_connections(user):
-        redis = Presence._connect()
+    def _update(user, channel_name, connected):
+        key = Presence._key(user)
+        now = time.time()
         try:
-            redis.incr(user)
-            redis.expire(user, settings.WS_KEY_EXPIRE)
-            return int(redis.get(user))
+            pipe = Presence._connect(user).pipeline()
+            if connected:
+                pipe.zadd(key, {channel_name: now + Presence._ttl()})
+            else:
+                pipe.zrem(key, channel_name)
+            pipe.zremrangebyscore(key, "-inf", now)
+            pipe.zcard(key)
+            pipe.expire(key, Presence._ttl())
+            Presence._publish_change(pipe, user)
+            return int(pipe.execute()[2])
         except Exception:
-            redis.delete(user)
-            redis.set(user, 0, ex=settings.WS_KEY_EXPIRE)
-            return int(redis.get(user))
+            return 0
+        finally:
+            Presence._invalidate(user)
+
+    @staticmethod
+    @instrument("presence.decrement_active_connections")
+    def decrement_active_connections(user, channel_name):
+        Presence._untrack(channel_name)
+        return Presence._update(user, channel_name, connected=False)
+
+    @staticmethod
+    @instrument("presence.increment_active_connections")
+    def increment_active_connections(user, channel_name):
+        Presence._track(user, channel_name)
+        return Presence._update(user, channel_name, connected=True)
+
+    @staticmethod
+    @instrument("presence.heartbeat")
+    def heartbeat():
+        with Presence._local_lock:
+            local = list(Presence._local.items())
+        if not local:
+            return 0
+        by_user = {}
+        for channel_name, user in local:
+            by_user.setdefault(user, []).append(channel_name)
+
+        expires = time.time() + Presence._ttl()
+
+        def refresh(users):
+            pipe = Presence._connect(users[0]).pipeline(transaction=False)
+            for user in users:
+                key = Presence._key(user)
+                pipe.zadd(key, {channel_name: expires for channel_name in by_user[user]})
+                pipe.expire(key, Presence._ttl())
+            pipe.execute()
+
+        Presence._map_shards(refresh, Presence._partition(by_user))
+        return len(local)
 
     @staticmethod
+    @instrument("presence.is_online")
     def is_online(user):
-        redis = Presence._connect()
+        if Presence.cache() is not None:
+            return user in Presence.online_many([user])
+
+        redis = Presence._connect(user)
         try:
-            return int(redis.get(user)) > 0
+            return redis.zcount(Presence._key(user), time.time(), "+inf") > 0
         except Exception:
             return False
+
+    @staticmethod
+    @instrument("presence.online_many")
+    def online_many(users):
+        users = list(users)
+        if not users:
+            return set()
+        cache = Presence.cache()
+        if cache is None:
+            return Presence._fetch_online(users) or set()
+
+        found, missing = cache.get_many(users)
+        online = {user for user, is_online in found.items() if is_online}
+        if missing:
+            generation = cache.generation
+            fetched = Presence._fetch_online(missing)
+            if fetched is not None:
+                cache.set_many({user: user in fetched for user in missing}, generation)
+                online |= fetched
+        return online
+
+    @staticmethod
+    def _fetch_online(users):
+        now = time.time()
+
+        def fetch(shard_users):
+            pipe = Presence._connect(shard_users[0]).pipeline(transaction=False)
+            for user in shard_users:
+                pipe.zcount(Presence._key(user), now, "+inf")
+            return {user for user, count in zip(shard_users, pipe.execute()) if count}
+
+        try:
+            results = Presence._map_shards(fetch, Presence._partition(users))
+        except Exception:
+            return None
+        return set().union(*results)
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceCache(object):
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, users):
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for user in users:
+                entry = self._entries.get(str(user))
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(str(user))
+                    found[user] = entry[0]
+                else:
+                    missing.append(user)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def set_many(self, values, generation):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if generation != self.generation:
+                return
+            for user, online in values.items():
+                self._entries[str(user)] = (online, expires)
+                self._entries.move_to_end(str(user))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._entries.pop(str(user), None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+            }
+
+
+class InvalidationListener(threading.Thread):
+    RECONNECT_DELAY = 1
+
+    def __init__(self, connect, channel, cache):
+        super().__init__(name="{}-invalidation".format(channel), daemon=True)
+        self.connect = connect
+        self.channel = channel
+        self.cache = cache
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.connect().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.cache.clear()
+                for message in pubsub.listen():
+                    key = message["data"]
+                    if isinstance(key, bytes):
+                        key = key.decode()
+                    self.cache.invalidate(key)
+            except Exception as error:
+                logger.error(f"{self.name} listener failed: {error}")
+            self.cache.clear()
+            time.sleep(self.RECONNECT_DELAY)
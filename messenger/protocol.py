@@ -1,86 +1,113 @@
+import asyncio
+import atexit
+import functools
+import threading
+import uuid
+
 from django.conf import settings
-from django.db.models import Q
+from django.db import connection, transaction
+from django.utils import timezone
 from channels.db import database_sync_to_async
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 
 from custom_auth.models import CustomUser
 from comms.models import Message
 from comms.serializers import MessageSerializer
 
-from .models import Room, RoomMember
+from .instrumentation import instrument, metrics, record_error, record_fanout
+from .membership import RoomMembership, membership_cache
+from .models import Room, RoomInbox, RoomMember, RoomMessage
 from .presence import Presence
+from .receipts import STATUS_PROGRESSION, Receipt, ReceiptBuffer
+from .throttling import activity_throttle
+from .writer import PendingSend, assign_id, message_writer
 
 
-class MessageValidator(object):
-    _DATA_TYPES = {"string": str, "array": list, "integer": int, "null": None}
-
-    def __init__(self, text):
-        self.text = text
-        self.commands = settings.RPC_PROTO_SPECS.get("commands")
-
-    @property
-    def is_valid(self):
-        if not self._command_exists():
-            return False
-        return all(
-            [
-                self._command_contents(),
-                self._command_param_types(),
-                self._params_not_empty(),
-            ]
-        )
+def room_group(room_id):
+    return "room.{}".format(room_id)
 
-    def _command_exists(self):
-        return self.text.get("command", False)
 
-    def _command_contents(self):
-        command_id = self.text["command"] in [
-            command["id"] for command in self.commands
-        ]
+class CompiledCommand(object):
+    _DATA_TYPES = {"string": str, "array": list, "integer": int, "null": type(None)}
 
-        if not command_id:
-            return False
+    __slots__ = ("id", "name", "param_ids", "param_types")
 
-        for command in self.commands:
-            if command["id"] == self.text["command"]:
-                self.command = command
-                self.message_params = self.text.copy()
-                self.message_params.pop("command")
-                self.params = command["params"]
-        return self._params_exists()
-
-    def _params_exists(self):
-        self.param_ids = [param["id"] for param in self.params]
-        return all([self.text.get(pid, False) for pid in self.param_ids])
-
-    def _command_param_types(self):
-        self.param_types = {
-            p["id"]: self._DATA_TYPES[p["type"]] for p in self.params
-        }  # noqa
-        return all(
-            isinstance(self.text.get(pid), self.param_types[pid])
-            for pid in self.param_ids
+    def __init__(self, command):
+        self.id = command["id"]
+        self.name = command["name"]
+        self.param_ids = tuple(param["id"] for param in command["params"])
+        self.param_types = tuple(
+            (param["id"], self._DATA_TYPES[param["type"]])
+            for param in command["params"]
         )
 
-    def _params_not_empty(self):
-        for value in self.message_params.values():
+    def is_valid(self, text):
+        for pid, param_type in self.param_types:
+            value = text.get(pid)
+            if not value or not isinstance(value, param_type):
+                return False
+        for key, value in text.items():
             if isinstance(value, (str, list)) and len(value) == 0:
                 return False
         return True
 
 
-class MessageResponse(object):
-    def __init__(self):
-        for ntf in settings.RPC_PROTO_SPECS.get("notifications"):
-            setattr(self, "_" + ntf["id"], ntf)
-        self._BASE_RESPONSE = {"type": "chat_message"}
-
-        self._ERRORS = {
-            "not_valid": "Message could not pass validation",
-            "user_not_found": "User not found",
-            "not_allowed": "Action not allowed",
+class ProtocolSpec(object):
+    _compiled = None
+
+    def __init__(self, source):
+        self.source = source
+        self.commands = {
+            command["id"]: CompiledCommand(command)
+            for command in source.get("commands")
+        }
+        self.notifications = {
+            notification["id"]: notification
+            for notification in source.get("notifications")
         }
 
+    @classmethod
+    def get(cls):
+        source = settings.RPC_PROTO_SPECS
+        compiled = cls._compiled
+        if compiled is None or compiled.source is not source:
+            compiled = cls(source)
+            cls._compiled = compiled
+        return compiled
+
+
+class MessageValidator(object):
+    def __init__(self, text):
+        self.text = text
+        self.commands = ProtocolSpec.get().commands
+
+    @property
+    def is_valid(self):
+        command_id = self.text.get("command")
+        if not isinstance(command_id, str):
+            return False
+        command = self.commands.get(command_id)
+        if command is None:
+            return False
+        return command.is_valid(self.text)
+
+
+class MessageResponse(object):
+    _BASE_RESPONSE = {"type": "chat_message"}
+
+    _ERRORS = {
+        "not_valid": "Message could not pass validation",
+        "user_not_found": "User not found",
+        "not_allowed": "Action not allowed",
+        "rate_limited": "Too many messages, slow down",
+    }
+
+    def __getattr__(self, name):
+        notifications = ProtocolSpec.get().notifications
+        if name.startswith("_") and name[1:] in notifications:
+            return notifications[name[1:]]
+        raise AttributeError(name)
+
     def N4(self, room_id, participants):
         out = self._BASE_RESPONSE.copy()
         out["id"] = self._N4["id"]
@@ -115,6 +142,7 @@ class MessageResponse(object):
         out["message_data"] = message_data
         out["message_id"] = message_data["id"]
         out["message_status"] = message_data["status"]["display"]
+        out["sequence"] = message_data["context"].get("seq")
         return out
 
     def N3(self, error):
@@ -122,6 +150,33 @@ class MessageResponse(object):
         out["error"] = self._ERRORS[error]
         return out
 
+    def N6(self, room_id, room_member_id, message_ids):
+        out = self._BASE_RESPONSE.copy()
+        out["id"] = self._N6["id"]
+        out["name"] = self._N6["name"]
+        out["room_id"] = room_id
+        out["room_member_id"] = room_member_id
+        out["message_ids"] = message_ids
+        return out
+
+    def N7(self, room_id, room_member_id, message_ids):
+        out = self._BASE_RESPONSE.copy()
+        out["id"] = self._N7["id"]
+        out["name"] = self._N7["name"]
+        out["room_id"] = room_id
+        out["room_member_id"] = room_member_id
+        out["message_ids"] = message_ids
+        return out
+
+    def N8(self, room_id, room_member_id, activity):
+        out = self._BASE_RESPONSE.copy()
+        out["id"] = self._N8["id"]
+        out["name"] = self._N8["name"]
+        out["room_id"] = room_id
+        out["room_member_id"] = room_member_id
+        out["activity"] = activity
+        return out
+
     def N5(self, messages):
         out = self._BASE_RESPONSE.copy()
         out["id"] = self._N5["id"]
@@ -130,10 +185,33 @@ class MessageResponse(object):
         return out
 
 
+message_response = MessageResponse()
+
+
+_receipt_buffer = None
+_receipt_buffer_lock = threading.Lock()
+
+
+def receipt_buffer():
+    global _receipt_buffer
+    if not getattr(settings, "MESSENGER_RECEIPT_BUFFER", False):
+        return None
+    if _receipt_buffer is None:
+        with _receipt_buffer_lock:
+            if _receipt_buffer is None:
+                _receipt_buffer = ReceiptBuffer(
+                    message_response,
+                    max_size=getattr(settings, "MESSENGER_RECEIPT_BUFFER_SIZE", 200),
+                    interval=getattr(settings, "MESSENGER_RECEIPT_FLUSH_INTERVAL", 0.5),
+                )
+                atexit.register(_receipt_buffer.flush)
+    return _receipt_buffer
+
+
 class ProtocolHandlerMixin(object):
     def message_is_valid(self, text_data):
         _validator = MessageValidator(text_data)
-        self.response = MessageResponse()
+        self.response = message_response
         return _validator.is_valid
 
     def process(self):
@@ -142,57 +220,80 @@ class ProtocolHandlerMixin(object):
             "C1": self.command1,
             "C2": self.command2,
             "C3": self.command3,
+            "C4": self.command4,
+            "C5": self.command5,
+            "C6": self.command6,
         }
-        bound = dispatch_map[self._message["command"]].__get__(self, type(self))
-        bound()
+        command = self._message["command"]
+        bound = dispatch_map[command].__get__(self, type(self))
+        registry = metrics()
+        try:
+            if registry is None:
+                return bound()
+            with registry.timer("messenger_command_seconds", command=command):
+                bound()
+        except Exception as error:
+            record_error(command, error)
+
+    def _group_send(self, group, event):
+        registry = metrics()
+        if registry is None:
+            return async_to_sync(self.channel_layer.group_send)(group, event)
+        with registry.timer("messenger_helper_seconds", helper="group_send"):
+            async_to_sync(self.channel_layer.group_send)(group, event)
 
     @database_sync_to_async
+    @instrument("get_users_from_message", db=True)
     def _get_users_from_message(self):
         return CustomUser.objects.filter(id__in=self._message["uids"])
 
     @database_sync_to_async
+    @instrument("get_related_rooms", db=True)
     def _get_related_rooms(self, all_room_members):
-        all_rooms = []
-        uids = []
-
-        for member in all_room_members:
-            room_member_objects = RoomMember.objects.filter(user=member)
-            if not room_member_objects.exists():
-                return None
-            all_rooms.append({member_object.room.id for member_object in room_member_objects})
-            uids.append(member.id)
-
-        intersection_rooms = set.intersection(*all_rooms) or None
-        should_create = True
-
-        if intersection_rooms:
-            for intersection_room in intersection_rooms:
-                if RoomMember.objects.filter(room_id=intersection_room).exclude(user__in=uids).exists():
-                    should_create = True
-                else:
-                    should_create = False
-                    valid_room = intersection_room
-
-        if should_create:
-            return None
-        return valid_room
+        members_key = Room.members_key_for(member.id for member in all_room_members)
+        return (
+            Room.objects.filter(members_key=members_key)
+            .values_list("id", flat=True)
+            .first()
+        )
 
     @database_sync_to_async
+    @instrument("create_room", db=True)
     def _create_room(self):
         return Room.objects.create(active=True)
 
     @database_sync_to_async
+    @instrument("get_room", db=True)
     def _get_room(self, rid):
         return Room.objects.get(id=rid)
 
     @database_sync_to_async
+    @instrument("add_roommembers", db=True)
     def _add_roommembers(self, users, room):
-        for user in users:
-            RoomMember.objects.create(room=room, user=user)
+        with transaction.atomic():
+            RoomMember.objects.bulk_create(
+                [RoomMember(room=room, user=user) for user in users]
+            )
+            RoomInbox.objects.bulk_create(
+                [RoomInbox(room=room, user=user) for user in users]
+            )
+            room.participants = [
+                {
+                    "user_id": user.id,
+                    "first_name": user.first_name,
+                    "last_name": user.last_name,
+                }
+                for user in users
+            ]
+            room.members_key = Room.members_key_for(user.id for user in users)
+            room.save(update_fields=["participants", "members_key"])
+        cache = membership_cache()
+        if cache is not None:
+            cache.set(room.id, room.participants)
 
     def command0(self):
-        users = self._get_users_from_message()
-        if users.count() == 0:
+        users = list(self._get_users_from_message())
+        if not users:
             self.send_json(self.response.N3("user_not_found"))
 
         all_room_members = [user for user in users]
@@ -202,6 +303,10 @@ class ProtocolHandlerMixin(object):
         if not room:
             room = self._create_room()
             self._add_roommembers(set(all_room_members), room)
+            for user in set(all_room_members):
+                self._group_send(
+                    user.id, self._room_join_event(room.id)
+                )
         else:
             room = self._get_room(room)
 
@@ -214,135 +319,580 @@ class ProtocolHandlerMixin(object):
             for user in all_room_members
         ]
 
+        online = Presence.online_many(user.id for user in users)
+        record_fanout("C0", len(online))
         for user in users:
-            if Presence.is_online(user.id):
-                async_to_sync(self.channel_layer.group_send)(
+            if user.id in online:
+                self._group_send(
                     user.id, self.response.N4(room.id, participants)
                 )
         self.send_json(self.response.N4(room.id, participants))
 
     @database_sync_to_async
-    def _get_members(self, room_id):
-        return RoomMember.objects.filter(room__id=room_id).exclude(user=self.me)
+    @instrument("get_room_ids", db=True)
+    def _get_room_ids(self):
+        return list(
+            RoomMember.objects.filter(user=self.me).values_list("room_id", flat=True)
+        )
+
+    @staticmethod
+    def _room_join_event(room_id):
+        return {"type": "room_join", "room_id": room_id}
+
+    def _room_message_event(self, serialized, messages):
+        return {
+            "type": "room_message",
+            "event_id": uuid.uuid4().hex,
+            "room_id": self._message["room_id"],
+            "sender": self.me.id,
+            "message": self.response.N0(serialized),
+            "copies": {str(message.recipient_id): message.id for message in messages},
+        }
+
+    def _encode_room_message(self, event):
+        codec = self.codec
+        message = event["message"]
+        if event["sender"] == self.me.id:
+            return codec.encode_shared((event["event_id"], None), message)
+        message_id = event["copies"].get(str(self.me.id))
+        if message_id is None:
+            return None
+        # Everything but the recipient's own ids is encoded once per event and
+        # spliced into each copy.
+        shared = codec.shared(
+            (event["event_id"], "shared"),
+            lambda: codec.encode_fields(
+                {
+                    key: value
+                    for key, value in message.items()
+                    if key not in ("message_id", "message_data")
+                }
+            ),
+        )
+        shared_data = codec.shared(
+            (event["event_id"], "shared_data"),
+            lambda: codec.encode_fields(
+                {
+                    key: value
+                    for key, value in message["message_data"].items()
+                    if key not in ("id", "recipient")
+                }
+            ),
+        )
+        message_data = codec.join_fields(
+            shared_data, codec.encode_fields({"id": message_id, "recipient": self.me.id})
+        )
+        return codec.join_fields(
+            shared,
+            codec.encode_fields({"message_id": message_id}),
+            codec.encode_field("message_data", message_data),
+        )
+
+    def _room_activity_event(self, room_id, activity):
+        return dict(
+            self.response.N8(room_id, self.me.id, activity),
+            type="room_activity",
+            event_id=uuid.uuid4().hex,
+        )
+
+    def _room_activity_for_me(self, event):
+        if event["room_member_id"] == self.me.id:
+            return None
+        out = dict(event, type=self.response._BASE_RESPONSE["type"])
+        del out["event_id"]
+        return out
+
+    def _activity_is_valid(self):
+        return self._message["activity"] in getattr(
+            settings, "MESSENGER_ACTIVITIES", ("typing", "paused")
+        )
+
+    def _get_membership(self, room_id):
+        cache = membership_cache()
+        membership = cache.get(room_id) if cache is not None else None
+        if membership is None:
+            membership = self._load_membership(room_id)
+        return membership
 
     @database_sync_to_async
-    def _can_communicate_in_room(self, room_id):
-        return RoomMember.objects.filter(room__id=room_id, user=self.me).exists()
+    @instrument("load_membership", db=True)
+    def _load_membership(self, room_id):
+        cache = membership_cache()
+        generation = cache.generation if cache is not None else None
+        participants = [
+            {
+                "user_id": member.user.id,
+                "first_name": member.user.first_name,
+                "last_name": member.user.last_name,
+            }
+            for member in RoomMember.objects.filter(room__id=room_id).select_related(
+                "user"
+            )
+        ]
+        if cache is not None:
+            return cache.set(room_id, participants, generation)
+        return RoomMembership(room_id, participants)
+
+    def _build_messages(self, recipient_ids, room_id, sequence, previous_id):
+        return [
+            Message(
+                protocol=Message.WS,
+                direction=Message.INCOMING,
+                status=Message.SENT,
+                content=self._message["message_data"],
+                recipient_id=recipient_id,
+                sender=self.me,
+                context={"room": room_id, "seq": sequence, "primary": index == 0},
+                previous_id=previous_id,
+            )
+            for index, recipient_id in enumerate(recipient_ids)
+        ]
 
     @database_sync_to_async
-    def _get_last_message(self, room_id):
-        try:
-            return Message.objects.filter(context__contains={"room": room_id}).latest(
-                "created_on"
+    @instrument("persist_messages", db=True)
+    def _persist_messages(self, recipient_ids):
+        if not recipient_ids:
+            return []
+        with transaction.atomic():
+            room = Room.objects.select_for_update().get(id=self._message["room_id"])
+            room.sequence += 1
+            messages = Message.objects.bulk_create(
+                self._build_messages(
+                    recipient_ids, room.id, room.sequence, room.last_message_id
+                )
             )
-        except Message.DoesNotExist:
-            return None
+            RoomMessage.objects.bulk_create(
+                [RoomMessage.for_message(message) for message in messages]
+            )
+            room.last_message = messages[-1]
+            room.save(update_fields=["sequence", "last_message", "updated_on"])
+            RoomInbox.advance(room.id, messages, timezone.now())
+            return messages
 
     @database_sync_to_async
-    def _persist_message(self, member):
-        message = Message(
-            protocol=Message.WS,
-            direction=Message.INCOMING,
-            status=Message.SENT,
-            content=self._message["message_data"],
-            recipient=member,
-            sender=self.me,
-            context={"room": self._message["room_id"]},
-            previous=self._get_last_message(self._message["room_id"]),
-        )
-        message.save()
-        return message
+    @instrument("write_behind", db=True)
+    def _write_behind(self, recipient_ids):
+        writer = message_writer()
+        if writer is None or not recipient_ids:
+            return None
+        room_id = self._message["room_id"]
+        messages = self._build_messages(recipient_ids, room_id, None, None)
+        if not all(assign_id(message) for message in messages):
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {} SET sequence = sequence + 1 WHERE id = %s "
+                "RETURNING sequence".format(Room._meta.db_table),
+                [Room._meta.pk.get_db_prep_value(room_id, connection)],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise Room.DoesNotExist()
+        now = timezone.now()
+        for message in messages:
+            message.context["seq"] = row[0]
+            message.created_on = now
+        writer.submit(PendingSend(room_id, row[0], messages))
+        return messages
+
+    def _store_messages(self, recipient_ids):
+        messages = self._write_behind(recipient_ids)
+        if messages is None:
+            messages = self._persist_messages(recipient_ids)
+        return messages
 
     def command1(self):
         try:
-            if not self._can_communicate_in_room(self._message["room_id"]):
+            membership = self._get_membership(self._message["room_id"])
+            if self.me.id not in membership.member_ids:
                 return self.send_json(self.response.N3("not_allowed"))
-            members = self._get_members(self._message["room_id"])
-            for member in members:
-                stored_message = self._persist_message(member.user)
-                serialized = MessageSerializer(stored_message)
-                if Presence.is_online(member.user.id):
-                    async_to_sync(self.channel_layer.group_send)(
-                        member.user.id, self.response.N0(serialized.data)
-                    )
-            async_to_sync(self.channel_layer.group_send)(
-                self.me.id, self.response.N0(serialized.data)
+            recipients = membership.recipients(self.me.id)
+            record_fanout("C1", len(recipients))
+            stored_messages = self._store_messages(recipients)
+            if not stored_messages:
+                return
+            serialized = MessageSerializer(stored_messages[-1]).data
+            self._group_send(
+                room_group(self._message["room_id"]),
+                self._room_message_event(serialized, stored_messages),
             )
-        except Exception as e:
-            print(e)
+        except Exception as error:
+            record_error("C1", error)
+
+    @staticmethod
+    def _flush_pending(message_ids):
+        writer = message_writer()
+        if writer is not None and writer.is_pending(message_ids):
+            writer.flush()
 
     @database_sync_to_async
+    @instrument("get_message", db=True)
     def _get_message(self, message_id):
+        self._flush_pending([message_id])
         return Message.objects.get(id=message_id)
 
     @database_sync_to_async
-    def _get_room_members(self, users):
-        return RoomMember.objects.filter(user__in=users).latest("id")
-
-    @database_sync_to_async
+    @instrument("update_message_status", db=True)
     def _update_message_status(self, message, status):
         message.status = status
-        message.save()
+        message.save(update_fields=["status"])
+
+    @database_sync_to_async
+    @instrument("update_messages_status", db=True)
+    def _update_messages_status(self, message_ids, status):
+        self._flush_pending(message_ids)
+        pending = Message.objects.filter(
+            id__in=message_ids,
+            recipient=self.me,
+            status__in=STATUS_PROGRESSION[: STATUS_PROGRESSION.index(status)],
+        )
+        with transaction.atomic():
+            updated = list(pending.select_for_update().values("id", "sender_id", "context"))
+            Message.objects.filter(id__in=[row["id"] for row in updated]).update(
+                status=status
+            )
+        return updated
+
+    @staticmethod
+    def _group_receipts(updated):
+        grouped = {}
+        for row in updated:
+            key = (row["sender_id"], row["context"].get("room"))
+            grouped.setdefault(key, []).append(row["id"])
+        return grouped
+
+    @staticmethod
+    def _buffer_receipt(message, status):
+        buffer = receipt_buffer()
+        if buffer is None:
+            return False
+        buffer.add(
+            Receipt(
+                message.id,
+                status,
+                message.sender_id,
+                message.recipient_id,
+                message.context.get("room"),
+            )
+        )
+        return True
+
+    def _receipt_batch_is_valid(self):
+        return len(self._message["message_ids"]) <= getattr(
+            settings, "MESSENGER_MAX_RECEIPT_BATCH", 500
+        )
 
     def command2(self):
         try:
             _msg = self._get_message(self._message["message_id"])
-            if self.me.id not in [_msg.sender.id, _msg.recipient.id]:
+            if self.me.id not in [_msg.sender_id, _msg.recipient_id]:
                 return self.send_json(self.response.N3("not_allowed"))
-            room_member_obj = self._get_room_members(
-                [_msg.sender.id, _msg.recipient.id]
-            )
-            async_to_sync(self.channel_layer.group_send)(
-                _msg.sender.id,
-                self.response.N1(room_member_obj.room_id, _msg.recipient.id, _msg.id),
+            if self._buffer_receipt(_msg, Message.RECEIVED):
+                return
+            self._group_send(
+                _msg.sender_id,
+                self.response.N1(
+                    _msg.context.get("room"), _msg.recipient_id, _msg.id
+                ),
             )
             self._update_message_status(_msg, Message.RECEIVED)
-        except Exception:
+        except Message.DoesNotExist:
+            self.send_json(self.response.N3("not_valid"))
+        except Exception as error:
+            record_error("C2", error)
             self.send_json(self.response.N3("not_valid"))
 
     def command3(self):
         try:
             _msg = self._get_message(self._message["message_id"])
-            if self.me.id not in [_msg.sender.id, _msg.recipient.id]:
+            if self.me.id not in [_msg.sender_id, _msg.recipient_id]:
                 return self.send_json(self.response.N3("not_allowed"))
-            room_member_obj = self._get_room_members(
-                [_msg.sender.id, _msg.recipient.id]
-            )
-            async_to_sync(self.channel_layer.group_send)(
-                _msg.sender.id,
-                self.response.N2(room_member_obj.room_id, _msg.recipient.id, _msg.id),
+            if self._buffer_receipt(_msg, Message.READ):
+                return
+            self._group_send(
+                _msg.sender_id,
+                self.response.N2(
+                    _msg.context.get("room"), _msg.recipient_id, _msg.id
+                ),
             )
             self._update_message_status(_msg, Message.READ)
-        except Exception:
+        except Message.DoesNotExist:
+            self.send_json(self.response.N3("not_valid"))
+        except Exception as error:
+            record_error("C3", error)
             self.send_json(self.response.N3("not_valid"))
 
+    def _acknowledge_many(self, notification, status):
+        if not self._receipt_batch_is_valid():
+            return self.send_json(self.response.N3("not_valid"))
+        try:
+            updated = self._update_messages_status(self._message["message_ids"], status)
+            for (sender_id, room_id), message_ids in self._group_receipts(
+                updated
+            ).items():
+                self._group_send(
+                    sender_id, notification(room_id, self.me.id, message_ids)
+                )
+        except Exception as error:
+            record_error(self._message["command"], error)
+            self.send_json(self.response.N3("not_valid"))
+
+    def command4(self):
+        self._acknowledge_many(self.response.N6, Message.RECEIVED)
+
+    def command5(self):
+        self._acknowledge_many(self.response.N7, Message.READ)
+
+    def command6(self):
+        if not self._activity_is_valid():
+            return self.send_json(self.response.N3("not_valid"))
+        room_id = self._message["room_id"]
+        membership = self._get_membership(room_id)
+        if self.me.id not in membership.member_ids:
+            return self.send_json(self.response.N3("not_allowed"))
+        if not activity_throttle().allow(
+            self.me.id,
+            room_id,
+            self._message["activity"],
+            functools.partial(self._schedule_activity, room_id),
+        ):
+            return
+        record_fanout("C6", len(membership.member_ids) - 1)
+        self._group_send(
+            room_group(room_id),
+            self._room_activity_event(room_id, self._message["activity"]),
+        )
+
+    def _schedule_activity(self, room_id, delay):
+        timer = threading.Timer(delay, self._trailing_activity, (room_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _trailing_activity(self, room_id):
+        activity = activity_throttle().trailing(self.me.id, room_id)
+        if activity is not None:
+            self._group_send(room_group(room_id), self._room_activity_event(room_id, activity))
+
+
+class AsyncProtocolHandlerMixin(ProtocolHandlerMixin):
+    async def process(self):
+        dispatch_map = {
+            "C0": self.command0,
+            "C1": self.command1,
+            "C2": self.command2,
+            "C3": self.command3,
+            "C4": self.command4,
+            "C5": self.command5,
+            "C6": self.command6,
+        }
+        command = self._message["command"]
+        registry = metrics()
+        try:
+            if registry is None:
+                return await dispatch_map[command]()
+            with registry.timer("messenger_command_seconds", command=command):
+                await dispatch_map[command]()
+        except Exception as error:
+            record_error(command, error)
+
+    async def _group_send(self, group, event):
+        registry = metrics()
+        if registry is None:
+            return await self.channel_layer.group_send(group, event)
+        with registry.timer("messenger_helper_seconds", helper="group_send"):
+            await self.channel_layer.group_send(group, event)
+
+    @database_sync_to_async
+    @instrument("get_users_from_message", db=True)
+    def _get_users_from_message(self):
+        return list(CustomUser.objects.filter(id__in=self._message["uids"]))
+
+    async def _get_membership(self, room_id):
+        cache = membership_cache()
+        membership = cache.get(room_id) if cache is not None else None
+        if membership is None:
+            membership = await self._load_membership(room_id)
+        return membership
+
+    @database_sync_to_async
+    @instrument("serialize_message", db=True)
+    def _serialize_message(self, message):
+        return MessageSerializer(message).data
+
+    async def _store_messages(self, recipient_ids):
+        messages = await self._write_behind(recipient_ids)
+        if messages is None:
+            messages = await self._persist_messages(recipient_ids)
+        return messages
+
+    async def command0(self):
+        users = await self._get_users_from_message()
+        if not users:
+            await self.send_json(self.response.N3("user_not_found"))
+
+        all_room_members = set(users)
+        all_room_members.add(self.me)
+        room, online = await asyncio.gather(
+            self._get_related_rooms(all_room_members),
+            sync_to_async(Presence.online_many)([user.id for user in users]),
+        )
+        record_fanout("C0", len(online))
+
+        if not room:
+            room = await self._create_room()
+            await self._add_roommembers(all_room_members, room)
+            await asyncio.gather(
+                *[
+                    self._group_send(
+                        user.id, self._room_join_event(room.id)
+                    )
+                    for user in all_room_members
+                ]
+            )
+        else:
+            room = await self._get_room(room)
+
+        participants = [
+            {
+                "user_id": user.id,
+                "first_name": user.first_name,
+                "last_name": user.last_name,
+            }
+            for user in all_room_members
+        ]
+
+        await asyncio.gather(
+            *[
+                self._group_send(
+                    user.id, self.response.N4(room.id, participants)
+                )
+                for user in users
+                if user.id in online
+            ]
+        )
+        await self.send_json(self.response.N4(room.id, participants))
+
+    async def command1(self):
+        try:
+            membership = await self._get_membership(self._message["room_id"])
+            if self.me.id not in membership.member_ids:
+                return await self.send_json(self.response.N3("not_allowed"))
+            recipients = membership.recipients(self.me.id)
+            record_fanout("C1", len(recipients))
+            stored_messages = await self._store_messages(recipients)
+            if not stored_messages:
+                return
+            serialized = await self._serialize_message(stored_messages[-1])
+            await self._group_send(
+                room_group(self._message["room_id"]),
+                self._room_message_event(serialized, stored_messages),
+            )
+        except Exception as error:
+            record_error("C1", error)
+
+    async def _acknowledge(self, notification, status):
+        try:
+            _msg = await self._get_message(self._message["message_id"])
+            if self.me.id not in [_msg.sender_id, _msg.recipient_id]:
+                return await self.send_json(self.response.N3("not_allowed"))
+            if self._buffer_receipt(_msg, status):
+                return
+            await asyncio.gather(
+                self._group_send(
+                    _msg.sender_id,
+                    notification(_msg.context.get("room"), _msg.recipient_id, _msg.id),
+                ),
+                self._update_message_status(_msg, status),
+            )
+        except Message.DoesNotExist:
+            await self.send_json(self.response.N3("not_valid"))
+        except Exception as error:
+            record_error(self._message["command"], error)
+            await self.send_json(self.response.N3("not_valid"))
+
+    async def command2(self):
+        await self._acknowledge(self.response.N1, Message.RECEIVED)
+
+    async def command3(self):
+        await self._acknowledge(self.response.N2, Message.READ)
+
+    async def _acknowledge_many(self, notification, status):
+        if not self._receipt_batch_is_valid():
+            return await self.send_json(self.response.N3("not_valid"))
+        try:
+            updated = await self._update_messages_status(
+                self._message["message_ids"], status
+            )
+            await asyncio.gather(
+                *[
+                    self._group_send(
+                        sender_id, notification(room_id, self.me.id, message_ids)
+                    )
+                    for (sender_id, room_id), message_ids in self._group_receipts(
+                        updated
+                    ).items()
+                ]
+            )
+        except Exception as error:
+            record_error(self._message["command"], error)
+            await self.send_json(self.response.N3("not_valid"))
+
+    async def command4(self):
+        await self._acknowledge_many(self.response.N6, Message.RECEIVED)
+
+    async def command5(self):
+        await self._acknowledge_many(self.response.N7, Message.READ)
+
+    async def command6(self):
+        if not self._activity_is_valid():
+            return await self.send_json(self.response.N3("not_valid"))
+        room_id = self._message["room_id"]
+        membership = await self._get_membership(room_id)
+        if self.me.id not in membership.member_ids:
+            return await self.send_json(self.response.N3("not_allowed"))
+        if not activity_throttle().allow(
+            self.me.id,
+            room_id,
+            self._message["activity"],
+            functools.partial(self._schedule_activity, room_id),
+        ):
+            return
+        record_fanout("C6", len(membership.member_ids) - 1)
+        await self._group_send(
+            room_group(room_id),
+            self._room_activity_event(room_id, self._message["activity"]),
+        )
+
+    def _schedule_activity(self, room_id, delay):
+        asyncio.get_event_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self._trailing_activity(room_id))
+        )
+
+    async def _trailing_activity(self, room_id):
+        activity = activity_throttle().trailing(self.me.id, room_id)
+        if activity is not None:
+            await self._group_send(
+                room_group(room_id), self._room_activity_event(room_id, activity)
+            )
+
 
 class Starter(object):
     @staticmethod
     def get_initial_info(me):
         out = []
-        response = MessageResponse()
+        response = message_response
         try:
-            for message in Message.objects.filter(
-                Q(sender=me) | Q(recipient=me), context__has_key="room"
-            ).distinct("context"):
-                room = {}
-                room.update({"room_id": message.context.get("room")})
-                room.update({"last_message": MessageSerializer(message).data})
-                room.update(
-                    {
-                        "participants": [
-                            {
-                                "user_id": member.user.id,
-                                "first_name": member.user.first_name,
-                                "last_name": member.user.last_name,
-                            }
-                            for member in RoomMember.objects.filter(
-                                room_id=message.context.get("room")
-                            )
-                        ]
-                    }
+            for inbox in (
+                RoomInbox.objects.filter(user=me, last_message__isnull=False)
+                .select_related(
+                    "room", "last_message__sender", "last_message__recipient"
                 )
+                .order_by("-last_activity")
+            ):
+                room = {}
+                room.update({"room_id": inbox.room_id})
+                room.update({"last_message": MessageSerializer(inbox.last_message).data})
+                room.update({"participants": inbox.room.participants})
                 out.append(room)
             return response.N5(out)
         except Exception:
@@ -0,0 +1,110 @@
+import logging
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import close_old_connections, transaction
+
+from comms.models import Message
+
+logger = logging.getLogger(__name__)
+
+STATUS_PROGRESSION = (Message.SENT, Message.RECEIVED, Message.READ)
+
+
+def is_forward(current, status):
+    return STATUS_PROGRESSION.index(status) > STATUS_PROGRESSION.index(current)
+
+
+class Receipt(object):
+    __slots__ = ("message_id", "status", "sender_id", "recipient_id", "room_id")
+
+    def __init__(self, message_id, status, sender_id, recipient_id, room_id):
+        self.message_id = message_id
+        self.status = status
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.room_id = room_id
+
+
+class ReceiptBuffer(object):
+    def __init__(self, response, max_size, interval):
+        self.response = response
+        self.max_size = max_size
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def add(self, receipt):
+        with self._lock:
+            self._merge(receipt)
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="receipt-flusher", daemon=True
+                )
+                self._worker.start()
+            if len(self._pending) >= self.max_size:
+                self._wakeup.set()
+
+    def _merge(self, receipt):
+        current = self._pending.get(receipt.message_id)
+        if current is None or is_forward(current.status, receipt.status):
+            self._pending[receipt.message_id] = receipt
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+            close_old_connections()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                self._write(batch.values())
+            except Exception as error:
+                logger.error(f"Receipt flush failed, requeueing {len(batch)}: {error}")
+                with self._lock:
+                    for receipt in batch.values():
+                        self._merge(receipt)
+                return
+            self._notify(batch.values())
+
+    def _write(self, receipts):
+        by_status = {}
+        for receipt in receipts:
+            by_status.setdefault(receipt.status, []).append(receipt.message_id)
+        with transaction.atomic():
+            for status, message_ids in by_status.items():
+                Message.objects.filter(
+                    id__in=message_ids,
+                    status__in=STATUS_PROGRESSION[: STATUS_PROGRESSION.index(status)],
+                ).update(status=status)
+
+    def _notify(self, receipts):
+        grouped = {}
+        for receipt in receipts:
+            key = (receipt.sender_id, receipt.room_id, receipt.recipient_id, receipt.status)
+            grouped.setdefault(key, []).append(receipt.message_id)
+
+        channel_layer = get_channel_layer()
+        for (sender_id, room_id, recipient_id, status), message_ids in grouped.items():
+            if status == Message.READ:
+                single, batched = self.response.N2, self.response.N7
+            else:
+                single, batched = self.response.N1, self.response.N6
+            if len(message_ids) == 1:
+                notification = single(room_id, recipient_id, message_ids[0])
+            else:
+                notification = batched(room_id, recipient_id, message_ids)
+            try:
+                async_to_sync(channel_layer.group_send)(sender_id, notification)
+            except Exception as error:
+                logger.error(f"Receipt notification to {sender_id} failed: {error}")
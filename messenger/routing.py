@@ -1,5 +1,23 @@
+from django.conf import settings
 from django.conf.urls import url
+from django.core.exceptions import ImproperlyConfigured
 
 from . import consumers
 
-websocket_urlpatterns = [url(r"ws/chat/", consumers.RPCConsumer)]
+RPC_CONSUMER = (
+    consumers.AsyncRPCConsumer
+    if getattr(settings, "MESSENGER_ASYNC_CONSUMER", False)
+    else consumers.RPCConsumer
+)
+
+# RPCConsumer hands each frame to the server inline from its worker thread, so
+# it has no outbound queue to bound and ignores the slow-client policies.
+if (
+    getattr(settings, "MESSENGER_OUTBOUND_BUFFER", None)
+    and RPC_CONSUMER is not consumers.AsyncRPCConsumer
+):
+    raise ImproperlyConfigured(
+        "MESSENGER_OUTBOUND_BUFFER requires MESSENGER_ASYNC_CONSUMER = True."
+    )
+
+websocket_urlpatterns = [url(r"ws/chat/", RPC_CONSUMER)]
@@ -0,0 +1,20 @@
+from rest_framework import serializers
+
+from comms.serializers import MessageSerializer
+
+from .models import RoomInbox
+
+
+class RoomInboxSerializer(serializers.ModelSerializer):
+    room_id = serializers.ReadOnlyField()
+    last_message = MessageSerializer(read_only=True)
+    participants = serializers.ReadOnlyField(source="room.participants")
+
+    class Meta:
+        model = RoomInbox
+        fields = ("room_id", "last_activity", "last_message", "participants")
+
+
+class RoomMessageSerializer(serializers.BaseSerializer):
+    def to_representation(self, instance):
+        return MessageSerializer(instance.message).data
@@ -0,0 +1,33 @@
+import bisect
+import hashlib
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing(object):
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash("{}#{}".format(node, replica)), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def index_for(self, key):
+        if len(self.nodes) == 1:
+            return 0
+        position = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._indexes[position]
+
+    def partition(self, keys):
+        shards = {}
+        for key in keys:
+            shards.setdefault(self.index_for(key), []).append(key)
+        return shards
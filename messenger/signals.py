@@ -0,0 +1,62 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from messenger.membership import membership_cache
+from messenger.models import Room, RoomMember
+from messenger.ws_token_auth import invalidate_user_tokens
+
+AUTH_FIELDS = ("is_active", "email", "password")
+NAME_FIELDS = ("first_name", "last_name")
+
+
+def _state(instance, fields):
+    # Read through __dict__ so deferred fields are not loaded just to be compared.
+    return tuple(instance.__dict__.get(field) for field in fields)
+
+
+def _changed(instance, fields, created):
+    state = _state(instance, fields)
+    previous = instance._tracked_state.get(fields)
+    instance._tracked_state[fields] = state
+    return not created and state != previous
+
+
+@receiver(post_init, sender=get_user_model())
+def remember_user_state(sender, instance, **kwargs):
+    instance._tracked_state = {
+        fields: _state(instance, fields) for fields in (AUTH_FIELDS, NAME_FIELDS)
+    }
+
+
+@receiver(post_save, sender=get_user_model())
+def invalidate_cached_tokens(sender, instance, created, **kwargs):
+    if _changed(instance, AUTH_FIELDS, created):
+        invalidate_user_tokens(instance.pk)
+
+
+@receiver(post_save, sender=get_user_model())
+def refresh_participant_names(sender, instance, created, **kwargs):
+    if not _changed(instance, NAME_FIELDS, created):
+        return
+    cache = membership_cache()
+    for room in Room.objects.filter(roommember__user=instance).distinct():
+        room.refresh_members()
+        if cache is not None:
+            cache.delete(room.id)
+
+
+@receiver(post_delete, sender=get_user_model())
+def invalidate_deleted_user_tokens(sender, instance, **kwargs):
+    invalidate_user_tokens(instance.pk)
+
+
+@receiver(post_save, sender=RoomMember)
+@receiver(post_delete, sender=RoomMember)
+def invalidate_room_membership(sender, instance, **kwargs):
+    room = Room.objects.filter(id=instance.room_id).first()
+    if room is not None:
+        room.refresh_members()
+    cache = membership_cache()
+    if cache is not None:
+        cache.delete(instance.room_id)
@@ -4,6 +4,8 @@ from comms.tests.factories import MessageFactory
 from comms.models import Message
 from custom_auth.factories import CustomUserFactory
 from custom_unittests import CustomTestCase
+from messenger.models import RoomInbox, RoomMessage
+from messenger.tests.factories import RoomFactory, RoomMemberFactory
 
 
 class TestInitialInfo(CustomTestCase):
@@ -26,3 +28,90 @@ class TestInitialInfo(CustomTestCase):
             response = self.client.get('/messenger/init_info/')
 
         self.assertEqual(200, response.status_code, response.content)
+
+    @override_settings(RPC_PROTO_SPECS=get_protocol_contents('proto1', path='src/messenger/'))
+    def test_initial_info_reads_inbox(self):
+        room = RoomFactory(participants=[{"user_id": self.user.id, "first_name": "", "last_name": ""}])
+        RoomInbox.objects.create(
+            user=self.user, room=room, last_message=self.message, last_activity=self.message.created_on
+        )
+        RoomInbox.objects.create(user=self.user, room=RoomFactory())
+        with self.client.authenticated_as(self.user):
+            response = self.client.get('/messenger/init_info/')
+
+        self.assertEqual(200, response.status_code, response.content)
+        rooms = response.json()["rooms"]
+        self.assertEqual(1, len(rooms))
+        self.assertEqual(room.id, rooms[0]["room_id"])
+
+
+class TestRoomPagination(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUserFactory()
+        self.other = CustomUserFactory()
+        self.room = RoomFactory()
+        RoomMemberFactory(user=self.user, room=self.room)
+        RoomMemberFactory(user=self.other, room=self.room)
+        self.messages = []
+        for _ in range(3):
+            message = MessageFactory()
+            message.protocol = Message.WS
+            message.direction = Message.INCOMING
+            message.status = Message.SENT
+            message.context = {"room": self.room.id}
+            message.sender = self.other
+            message.recipient = self.user
+            message.save()
+            RoomMessage.for_message(message).save()
+            self.messages.append(message)
+        for _ in range(3):
+            room = RoomFactory()
+            RoomInbox.objects.create(
+                user=self.user, room=room, last_message=self.messages[-1],
+                last_activity=self.messages[-1].created_on
+            )
+
+    def test_room_list_is_paginated(self):
+        with self.client.authenticated_as(self.user):
+            response = self.client.get('/messenger/rooms/?page_size=2')
+
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(2, len(response.json()["results"]))
+        self.assertIsNotNone(response.json()["next"])
+
+    def test_room_history_is_paginated(self):
+        with self.client.authenticated_as(self.user):
+            response = self.client.get('/messenger/rooms/{}/messages/?page_size=2'.format(self.room.id))
+
+        self.assertEqual(200, response.status_code, response.content)
+        results = response.json()["results"]
+        self.assertEqual(2, len(results))
+        self.assertEqual(self.messages[-1].id, results[0]["id"])
+        self.assertIsNotNone(response.json()["next"])
+
+    def test_room_history_requires_membership(self):
+        outsider = CustomUserFactory()
+        with self.client.authenticated_as(outsider):
+            response = self.client.get('/messenger/rooms/{}/messages/'.format(self.room.id))
+
+        self.assertEqual(404, response.status_code, response.content)
+
+    def test_room_history_shows_only_primary_sent_copy(self):
+        copies = []
+        for primary in (True, False):
+            message = MessageFactory()
+            message.context = {"room": self.room.id, "primary": primary}
+            message.sender = self.user
+            message.recipient = self.other
+            message.save()
+            RoomMessage.for_message(message).save()
+            copies.append(message)
+
+        with self.client.authenticated_as(self.user):
+            response = self.client.get('/messenger/rooms/{}/messages/'.format(self.room.id))
+
+        ids = [result["id"] for result in response.json()["results"]]
+        self.assertIn(copies[0].id, ids)
+        self.assertNotIn(copies[1].id, ids)
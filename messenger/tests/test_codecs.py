@@ -0,0 +1,48 @@
+from django.test import override_settings
+from custom_unittests import CustomTestCase
+from messenger.codecs import available_codecs, default_codec, negotiate
+
+
+class TestCodecs(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.payload = {"type": "chat_message", "id": "N1", "room_id": "abc", "message_id": 1}
+
+    def test_negotiate_defaults_to_token(self):
+        codec, subprotocol = negotiate(["token"])
+        self.assertIs(codec, default_codec)
+        self.assertEqual("token", subprotocol)
+
+    def test_negotiate_picks_offered_codec(self):
+        codec, subprotocol = negotiate(["token", "unknown", "rtm.json"])
+        self.assertEqual("rtm.json", subprotocol)
+        self.assertIs(codec, available_codecs["rtm.json"])
+
+    @override_settings(MESSENGER_CODECS=["rtm.json"])
+    def test_negotiate_ignores_disabled_codec(self):
+        _, subprotocol = negotiate(["token", "rtm.msgpack"])
+        self.assertEqual("token", subprotocol)
+
+    def test_round_trip(self):
+        for codec in available_codecs.values():
+            data = codec.encode(self.payload)
+            if codec.binary:
+                self.assertEqual(self.payload, codec.decode(bytes_data=data))
+            else:
+                self.assertEqual(self.payload, codec.decode(text_data=data))
+
+    def test_encode_shared_reuses_bytes(self):
+        first = default_codec.encode_shared(("event", 1), self.payload)
+        second = default_codec.encode_shared(("event", 1), dict(self.payload, room_id="other"))
+        self.assertIs(first, second)
+
+    def test_join_fields_matches_merged_encoding(self):
+        for codec in available_codecs.values():
+            data = codec.join_fields(
+                codec.encode_fields(self.payload),
+                codec.encode_fields({"recipient": 7}),
+                codec.encode_field("nested", codec.encode({"a": 1})),
+            )
+            decoded = codec.decode(bytes_data=data) if codec.binary else codec.decode(text_data=data)
+            self.assertEqual(dict(self.payload, recipient=7, nested={"a": 1}), decoded)
@@ -0,0 +1,82 @@
+from unittest.mock import MagicMock
+from django.test import override_settings
+from messenger.helpers import get_protocol_contents
+from custom_unittests import CustomTestCase
+from messenger.instrumentation import MetricsRegistry, instrument, metrics
+from messenger.protocol import ProtocolHandlerMixin, message_response
+
+
+class TestMetricsRegistry(CustomTestCase):
+
+    def test_render_histogram_and_counter(self):
+        registry = MetricsRegistry()
+        registry.observe("messenger_command_seconds", 0.003, command="C1")
+        registry.observe("messenger_command_seconds", 2, command="C1")
+        registry.inc("messenger_errors_total", command="C1")
+        output = registry.render()
+        self.assertIn('messenger_command_seconds_bucket{command="C1",le="0.005"} 1', output)
+        self.assertIn('messenger_command_seconds_bucket{command="C1",le="+Inf"} 2', output)
+        self.assertIn('messenger_command_seconds_count{command="C1"} 2', output)
+        self.assertIn('messenger_errors_total{command="C1"} 1', output)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(metrics())
+        wrapped = instrument("helper", db=True)(lambda: 42)
+        self.assertEqual(42, wrapped())
+
+
+@override_settings(
+    MESSENGER_METRICS=True,
+    MESSENGER_METRICS_TOKEN="scrape-token",
+    RPC_PROTO_SPECS=get_protocol_contents('proto1', path='src/messenger/'),
+)
+class TestProtocolInstrumentation(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics().clear()
+
+    def test_process_records_command_timing(self):
+        protocol = ProtocolHandlerMixin()
+        protocol.me = MagicMock(id=1)
+        protocol.response = message_response
+        protocol._message = {"command": "C5", "message_ids": ["missing"] * 501}
+        protocol.send_json = MagicMock()
+        protocol.process()
+        self.assertIn('messenger_command_seconds_count{command="C5"} 1', metrics().render())
+
+    def test_process_records_errors(self):
+        protocol = ProtocolHandlerMixin()
+        protocol.me = MagicMock(id=1)
+        protocol.response = message_response
+        protocol._message = {"command": "C0", "uids": [1]}
+        protocol._get_users_from_message = MagicMock(side_effect=RuntimeError("boom"))
+        protocol.process()
+        self.assertIn('messenger_errors_total{command="C0"} 1', metrics().render())
+
+    def test_helper_records_queries(self):
+        wrapped = instrument("noop", db=True)(lambda: None)
+        wrapped()
+        output = metrics().render()
+        self.assertIn('messenger_helper_seconds_count{helper="noop"} 1', output)
+        self.assertIn('messenger_helper_queries_count{helper="noop"} 1', output)
+
+    def test_exporter(self):
+        metrics().inc("messenger_errors_total", command="C1")
+        response = self.client.get(
+            '/messenger/metrics/', HTTP_AUTHORIZATION="Bearer scrape-token"
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'messenger_errors_total{command="C1"} 1', response.content)
+
+    def test_exporter_requires_token(self):
+        for headers in ({}, {"HTTP_AUTHORIZATION": "Bearer wrong"}):
+            response = self.client.get('/messenger/metrics/', **headers)
+            self.assertIn(response.status_code, (401, 403))
+
+    @override_settings(MESSENGER_METRICS=False)
+    def test_exporter_disabled(self):
+        response = self.client.get(
+            '/messenger/metrics/', HTTP_AUTHORIZATION="Bearer scrape-token"
+        )
+        self.assertEqual(404, response.status_code)
@@ -1,5 +1,7 @@
-from .factories import RoomFactory
+from .factories import RoomFactory, RoomMemberFactory
 from custom_unittests import CustomTestCase
+from custom_auth.factories import CustomUserFactory
+from messenger.models import Room
 
 
 class TestRoomModel(CustomTestCase):
@@ -12,3 +14,28 @@ class TestRoomModel(CustomTestCase):
         room.active = True
         room.save()
         self.assertEqual(True, room.active)
+
+    def test_members_key_follows_room_members(self):
+        room = RoomFactory()
+        first, second = CustomUserFactory(), CustomUserFactory()
+        RoomMemberFactory(user=first, room=room)
+        member = RoomMemberFactory(user=second, room=room)
+        room.refresh_from_db()
+        self.assertEqual(Room.members_key_for([first.id, second.id]), room.members_key)
+
+        member.delete()
+        room.refresh_from_db()
+        self.assertEqual(Room.members_key_for([first.id]), room.members_key)
+
+    def test_participants_follow_members_and_names(self):
+        room = RoomFactory()
+        first, second = CustomUserFactory(), CustomUserFactory()
+        RoomMemberFactory(user=first, room=room)
+        RoomMemberFactory(user=second, room=room)
+        second.first_name = "Renamed"
+        second.save()
+        room.refresh_from_db()
+        self.assertEqual(
+            [(first.id, first.first_name), (second.id, "Renamed")],
+            [(p["user_id"], p["first_name"]) for p in room.participants],
+        )
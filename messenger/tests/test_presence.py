@@ -4,6 +4,7 @@ from messenger.helpers import get_protocol_contents
 from custom_unittests import CustomTestCase
 from fakeredis import FakeStrictRedis
 from messenger.presence import Presence
+from messenger.presence_cache import PresenceCache
 
 
 @override_settings(RPC_PROTO_SPECS=get_protocol_contents('proto1', path='src/messenger/'))
@@ -18,13 +19,82 @@ class TestPresence(CustomTestCase):
 
     def test_increment_no_user(self):
         with patch.object(Presence, '_connect', return_value=FakeStrictRedis()) as mock_method:
-            self.assertEqual(1, Presence.increment_active_connections("test_user1"))
+            self.assertEqual(1, Presence.increment_active_connections("test_user1", "channel.1"))
 
     def test_decrement_no_user(self):
         with patch.object(Presence, '_connect', return_value=FakeStrictRedis()) as mock_method:
-            self.assertEqual(0, Presence.decrement_active_connections("test_user2"))
+            self.assertEqual(0, Presence.decrement_active_connections("test_user2", "channel.2"))
+
+    def test_online_many(self):
+        with patch.object(Presence, '_connect', return_value=FakeStrictRedis()) as mock_method:
+            Presence.increment_active_connections("test_user3", "channel.3")
+            Presence.increment_active_connections("test_user4", "channel.4")
+            Presence.decrement_active_connections("test_user4", "channel.4")
+            self.assertEqual(
+                {"test_user3"},
+                Presence.online_many(["test_user3", "test_user4", "test_user5"])
+            )
+
+    def test_online_many_empty(self):
+        self.assertEqual(set(), Presence.online_many([]))
+
+    def test_connections_are_counted_per_socket(self):
+        with patch.object(Presence, '_connect', return_value=FakeStrictRedis()):
+            Presence.increment_active_connections("test_user6", "channel.6a")
+            self.assertEqual(2, Presence.increment_active_connections("test_user6", "channel.6b"))
+            self.assertEqual(1, Presence.decrement_active_connections("test_user6", "channel.6a"))
+            self.assertTrue(Presence.is_online("test_user6"))
+
+    def test_expired_connections_are_offline_and_pruned(self):
+        redis = FakeStrictRedis()
+        redis.zadd("presence:test_user7", {"channel.dead": 1})
+        with patch.object(Presence, '_connect', return_value=redis):
+            self.assertFalse(Presence.is_online("test_user7"))
+            self.assertEqual(set(), Presence.online_many(["test_user7"]))
+            self.assertEqual(1, Presence.increment_active_connections("test_user7", "channel.7"))
+            self.assertEqual([b"channel.7"], redis.zrange("presence:test_user7", 0, -1))
+
+    def test_heartbeat_refreshes_local_sockets(self):
+        redis = FakeStrictRedis()
+        with patch.object(Presence, '_connect', return_value=redis):
+            Presence.increment_active_connections("test_user8", "channel.8")
+            before = redis.zscore("presence:test_user8", "channel.8")
+            self.assertGreaterEqual(Presence.heartbeat(), 1)
+            self.assertGreaterEqual(redis.zscore("presence:test_user8", "channel.8"), before)
+            Presence.decrement_active_connections("test_user8", "channel.8")
+            self.assertNotIn("channel.8", Presence._local)
 
     def tearDown(self):
         super().tearDown()
         redis = FakeStrictRedis()
         redis.flushdb()
+
+
+class TestPresenceCache(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = PresenceCache(ttl=60, max_size=2)
+
+    def test_miss_then_hit(self):
+        self.assertEqual(({}, ["u1"]), self.cache.get_many(["u1"]))
+        self.cache.set_many({"u1": True}, self.cache.generation)
+        self.assertEqual(({"u1": True}, []), self.cache.get_many(["u1"]))
+        self.assertEqual(1, self.cache.stats()["hits"])
+        self.assertEqual(1, self.cache.stats()["misses"])
+
+    def test_invalidate(self):
+        self.cache.set_many({"u1": True}, self.cache.generation)
+        self.cache.invalidate("u1")
+        self.assertEqual(({}, ["u1"]), self.cache.get_many(["u1"]))
+
+    def test_stale_generation_not_stored(self):
+        generation = self.cache.generation
+        self.cache.invalidate("u1")
+        self.cache.set_many({"u1": True}, generation)
+        self.assertEqual(0, self.cache.stats()["size"])
+
+    def test_bounded_size(self):
+        self.cache.set_many({"u1": True, "u2": False, "u3": True}, self.cache.generation)
+        self.assertEqual(2, self.cache.stats()["size"])
+        self.assertEqual(({}, ["u1"]), self.cache.get_many(["u1"]))
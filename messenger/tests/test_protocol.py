@@ -1,8 +1,14 @@
+from unittest.mock import MagicMock, patch
+from asgiref.sync import async_to_sync
+from django.db import connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from messenger.codecs import available_codecs, default_codec
 from messenger.helpers import get_protocol_contents
 from custom_unittests import CustomTestCase
-from messenger.protocol import ProtocolHandlerMixin, MessageResponse
-from messenger.models import RoomMember, Room
+from messenger.protocol import AsyncProtocolHandlerMixin, ProtocolHandlerMixin, MessageResponse
+from messenger.models import RoomMember, Room, RoomMessage
+from messenger.throttling import ActivityThrottle
 from messenger.tests.factories import RoomFactory, RoomMemberFactory
 from custom_auth.factories import CustomUserFactory
 from comms.tests.factories import MessageFactory
@@ -26,16 +32,19 @@ class TestProtocol(CustomTestCase):
         self.message.context = {"room": self.room.id}
         self.message.sender = self.user
         self.message.save()
+        self.room.last_message = self.message
+        self.room.save()
 
         self.rmb = RoomMemberFactory(user=self.user, room=self.room)
         self.rmb1 = RoomMemberFactory(user=self.user1, room=self.room)
+        self.room.refresh_members_key()
 
         self.C0_valid = {"command": "C0", "uids": [self.user.id]}
         self.C0_valid_with_invalid_user = {"command": "C0", "uids": ["invalid_user"]}
         self.C0_invalid = {"command": "C0", "uids": "pe-ak9"}
         self.C0_invalid1 = {"command": "C0", "uids": []}
 
-        self.C1_valid = {"command": "C1", "room_id": "lqlqlq", "message_data": "test"}
+        self.C1_valid = {"command": "C1", "room_id": self.room.id, "message_data": "test"}
         self.C1_invalid = {"command": "C1", "non": "valid"}
 
         self.C2_valid = {"command": "C2", "message_id": "123"}
@@ -44,6 +53,15 @@ class TestProtocol(CustomTestCase):
         self.C3_valid = {"command": "C3", "message_id": "123"}
         self.C3_invalid = {"command": "C3", "non": "valid"}
 
+        self.C4_valid = {"command": "C4", "message_ids": ["123", "456"]}
+        self.C4_invalid = {"command": "C4", "message_ids": []}
+
+        self.C5_valid = {"command": "C5", "message_ids": ["123"]}
+        self.C5_invalid = {"command": "C5", "message_ids": "123"}
+
+        self.C6_valid = {"command": "C6", "room_id": self.room.id, "activity": "typing"}
+        self.C6_invalid = {"command": "C6", "room_id": self.room.id}
+
         self.invalid_message = {"non": "valid"}
 
     def test_get_users_from_message(self):
@@ -60,6 +78,11 @@ class TestProtocol(CustomTestCase):
         room = self.protocol._get_related_rooms([self.user, self.user1])
         self.assertEqual(room, self.room.id)
 
+    def test_get_related_rooms_requires_exact_members(self):
+        user2 = CustomUserFactory()
+        self.assertIsNone(self.protocol._get_related_rooms([self.user]))
+        self.assertIsNone(self.protocol._get_related_rooms([self.user, self.user1, user2]))
+
     def test_get_rid(self):
         self.assertEqual(self.room.id, self.protocol._get_room(self.room.id).id)
 
@@ -68,21 +91,33 @@ class TestProtocol(CustomTestCase):
         self.protocol._add_roommembers([self.user, self.user1], room1)
         room_member = RoomMember.objects.filter(room=room1)
         self.assertTrue(room_member.exists())
-
-    def test_get_members(self):
-        self.protocol.me = self.user
-        members = self.protocol._get_members(self.room.id)
-        self.assertEqual(int(members[0].user.id), self.user1.id)
-
-    def test_get_last_message(self):
-        self.assertEqual(self.protocol._get_last_message(self.room.id).id, self.message.id)
+        room1.refresh_from_db()
+        self.assertEqual(room1.members_key, Room.members_key_for([self.user.id, self.user1.id]))
+
+    def test_async_C1_persists_and_broadcasts(self):
+        protocol = AsyncProtocolHandlerMixin()
+        protocol.me = self.user
+        protocol.response = self.response
+        protocol._message = {"command": "C1", "room_id": self.room.id, "message_data": "async"}
+        protocol.send_json = MagicMock()
+        protocol.channel_layer = MagicMock()
+        sent = []
+
+        async def group_send(group, event):
+            sent.append(event)
+
+        protocol._group_send = group_send
+        async_to_sync(protocol.process)()
+        link = RoomMessage.objects.get(room=self.room, recipient=self.user1)
+        self.assertEqual(self.user.id, link.sender_id)
+        self.assertTrue(Message.objects.filter(id=link.message_id).exists())
+        self.assertEqual(1, len(sent))
+        self.assertEqual("N0", sent[0]["message"]["id"])
+        self.assertEqual(link.message_id, sent[0]["copies"][str(self.user1.id)])
 
     def test_get_message(self):
         self.assertEqual(self.protocol._get_message(self.message.id).id, self.message.id)
 
-    def test_get_room_members(self):
-        self.assertEqual(self.protocol._get_room_members([self.user]).id, self.rmb.id)
-
     def test_create_room(self):
         room = self.protocol._create_room()
         self.assertTrue(Room.objects.filter(id=room.id).exists())
@@ -92,16 +127,96 @@ class TestProtocol(CustomTestCase):
         self.protocol._update_message_status(self.message, status)
         self.assertEqual(self.message.status, status)
 
-    def test_persist_message(self):
+    def test_update_messages_status(self):
+        self.protocol.me = self.user1
+        self.message.recipient = self.user1
+        self.message.save()
+        updated = self.protocol._update_messages_status([self.message.id], Message.READ)
+        self.assertEqual([self.message.id], [row["id"] for row in updated])
+        self.message.refresh_from_db()
+        self.assertEqual(Message.READ, self.message.status)
+
+    def test_update_messages_status_is_forward_only(self):
+        self.protocol.me = self.user1
+        self.message.recipient = self.user1
+        self.message.status = Message.READ
+        self.message.save()
+        updated = self.protocol._update_messages_status([self.message.id], Message.RECEIVED)
+        self.assertEqual([], updated)
+        self.message.refresh_from_db()
+        self.assertEqual(Message.READ, self.message.status)
+
+    def test_update_messages_status_only_for_recipient(self):
+        self.protocol.me = self.user
+        self.message.recipient = self.user1
+        self.message.save()
+        self.assertEqual([], self.protocol._update_messages_status([self.message.id], Message.READ))
+
+    def test_group_receipts(self):
+        grouped = ProtocolHandlerMixin._group_receipts([
+            {"id": "a", "sender_id": 1, "context": {"room": "r1"}},
+            {"id": "b", "sender_id": 1, "context": {"room": "r1"}},
+            {"id": "c", "sender_id": 2, "context": {"room": "r2"}},
+        ])
+        self.assertEqual({(1, "r1"): ["a", "b"], (2, "r2"): ["c"]}, grouped)
+
+    def test_persist_messages(self):
+        self.protocol.me = self.user
+        self.protocol._message = self.C1_valid
+        user2 = CustomUserFactory()
+        messages = self.protocol._persist_messages([self.user1.id, user2.id])
+        self.assertEqual(2, Message.objects.filter(id__in=[m.id for m in messages]).count())
+        self.assertEqual(messages[0].previous_id, messages[1].previous_id)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, messages[-1].id)
+        self.assertEqual(self.room.sequence, messages[0].context["seq"])
+        links = RoomMessage.objects.filter(room=self.room).order_by("-primary")
+        self.assertEqual([True, False], [link.primary for link in links])
+        self.assertEqual(self.room.sequence, links[0].sequence)
+
+    def test_persist_messages_sequence_is_monotonic(self):
         self.protocol.me = self.user
         self.protocol._message = self.C1_valid
-        message = self.protocol._persist_message(self.user1)
-        msg_obj = Message.objects.filter(id=message.id)
-        self.assertTrue(msg_obj.exists())
+        first = self.protocol._persist_messages([self.user1.id])
+        second = self.protocol._persist_messages([self.user1.id])
+        self.assertEqual(first[0].context["seq"] + 1, second[0].context["seq"])
+        self.assertEqual(first[0].id, second[0].previous_id)
 
-    def test_can_communicate_in_room(self):
+    def test_encode_room_message(self):
         self.protocol.me = self.user
-        self.assertTrue(self.protocol._can_communicate_in_room(self.room.id))
+        self.protocol.response = self.response
+        self.protocol._message = self.C1_valid
+        messages = self.protocol._persist_messages([self.user1.id])
+        serialized = {"id": messages[0].id, "context": messages[0].context, "status": {"display": "Sent"}}
+        event = self.protocol._room_message_event(serialized, messages)
+        for codec in available_codecs.values():
+            recipient = ProtocolHandlerMixin()
+            recipient.me = self.user1
+            recipient.codec = codec
+            data = recipient._encode_room_message(event)
+            frame = codec.decode(bytes_data=data) if codec.binary else codec.decode(text_data=data)
+            self.assertEqual(messages[0].id, frame["message_id"])
+            self.assertEqual(messages[0].id, frame["message_data"]["id"])
+            self.assertEqual(self.user1.id, frame["message_data"]["recipient"])
+            self.assertEqual("N0", frame["id"])
+
+        outsider = ProtocolHandlerMixin()
+        outsider.me = CustomUserFactory()
+        outsider.codec = default_codec
+        self.assertIsNone(outsider._encode_room_message(event))
+
+    def test_get_membership(self):
+        membership = self.protocol._get_membership(self.room.id)
+        self.assertEqual({self.user.id, self.user1.id}, membership.member_ids)
+        self.assertEqual([self.user1.id], membership.recipients(self.user.id))
+
+    @override_settings(MESSENGER_MEMBERSHIP_CACHE=True)
+    def test_get_membership_cached(self):
+        with patch('messenger.membership.InvalidationListener'):
+            self.protocol._get_membership(self.room.id)
+            with self.assertNumQueries(0):
+                membership = self.protocol._get_membership(self.room.id)
+        self.assertIn(self.user.id, membership.member_ids)
 
     def test_C0_valid(self):
         self.assertTrue(self.protocol.message_is_valid(self.C0_valid))
@@ -130,6 +245,94 @@ class TestProtocol(CustomTestCase):
     def test_C3_invalid(self):
         self.assertFalse(self.protocol.message_is_valid(self.C3_invalid))
 
+    def test_C4_valid(self):
+        self.assertTrue(self.protocol.message_is_valid(self.C4_valid))
+
+    def test_C4_invalid(self):
+        self.assertFalse(self.protocol.message_is_valid(self.C4_invalid))
+
+    def test_C5_valid(self):
+        self.assertTrue(self.protocol.message_is_valid(self.C5_valid))
+
+    def test_C5_invalid(self):
+        self.assertFalse(self.protocol.message_is_valid(self.C5_invalid))
+
+    def test_C6_valid(self):
+        self.assertTrue(self.protocol.message_is_valid(self.C6_valid))
+
+    def test_C6_invalid(self):
+        self.assertFalse(self.protocol.message_is_valid(self.C6_invalid))
+
+    @patch('messenger.protocol.activity_throttle')
+    def test_C6_broadcasts_once_per_window(self, activity_throttle):
+        activity_throttle.return_value = ActivityThrottle(window=60, max_size=10)
+        self.protocol.me = self.user
+        self.protocol.response = self.response
+        self.protocol._message = self.C6_valid
+        self.protocol.send_json = MagicMock()
+        with patch.object(ProtocolHandlerMixin, '_group_send') as group_send, \
+                patch.object(ProtocolHandlerMixin, '_schedule_activity') as schedule, \
+                CaptureQueriesContext(connection) as queries:
+            self.protocol.process()
+            self.protocol.process()
+        group_send.assert_called_once()
+        schedule.assert_called_once()
+        self.assertEqual(self.room.id, schedule.call_args[0][0])
+        event = group_send.call_args[0][1]
+        self.assertEqual("N8", event["id"])
+        self.assertEqual("room_activity", event["type"])
+        self.assertFalse(any("comms_message" in query["sql"] for query in queries))
+        self.protocol.send_json.assert_not_called()
+
+        self.assertIsNone(self.protocol._room_activity_for_me(event))
+        other = ProtocolHandlerMixin()
+        other.me = self.user1
+        other.response = self.response
+        frame = other._room_activity_for_me(event)
+        self.assertEqual("chat_message", frame["type"])
+        self.assertNotIn("event_id", frame)
+        self.assertIs(
+            default_codec.encode_shared(event["event_id"], frame),
+            default_codec.encode_shared(event["event_id"], dict(frame)),
+        )
+
+    @patch('messenger.protocol.activity_throttle')
+    def test_C6_trailing_activity(self, activity_throttle):
+        activity_throttle.return_value = ActivityThrottle(window=60, max_size=10)
+        self.protocol.me = self.user
+        self.protocol.response = self.response
+        self.protocol._message = self.C6_valid
+        self.protocol.send_json = MagicMock()
+        with patch.object(ProtocolHandlerMixin, '_group_send') as group_send, \
+                patch.object(ProtocolHandlerMixin, '_schedule_activity'):
+            self.protocol.process()
+            self.protocol.process()
+            self.protocol._trailing_activity(self.room.id)
+            self.protocol._trailing_activity(self.room.id)
+        self.assertEqual(2, group_send.call_count)
+        self.assertEqual("typing", group_send.call_args[0][1]["activity"])
+
+    def test_C6_rejects_unknown_activity(self):
+        self.protocol.me = self.user
+        self.protocol.response = self.response
+        self.protocol._message = dict(self.C6_valid, activity="dancing")
+        self.protocol.send_json = MagicMock()
+        self.protocol.process()
+        self.protocol.send_json.assert_called_once_with(self.response.N3("not_valid"))
+
+    def test_unknown_command(self):
+        self.assertFalse(self.protocol.message_is_valid({"command": "C99", "room_id": "x"}))
+
+    def test_non_string_command(self):
+        for command in (["C1"], {}, 1, None):
+            self.assertFalse(self.protocol.message_is_valid({"command": command, "room_id": "x"}))
+
+    def test_response_is_shared(self):
+        self.protocol.message_is_valid(self.C2_valid)
+        response = self.protocol.response
+        self.protocol.message_is_valid(self.C3_valid)
+        self.assertIs(response, self.protocol.response)
+
     def test_invalid_message(self):
         self.assertFalse(self.protocol.message_is_valid(self.invalid_message))
 
@@ -137,6 +340,10 @@ class TestProtocol(CustomTestCase):
         r = self.response.N0({"context": {"room": "123"}, "id": "321", "status": {"display": "OK"}})
         self.assertTrue(isinstance(r, dict))
 
+    def test_N0_sequence(self):
+        r = self.response.N0({"context": {"room": "123", "seq": 7}, "id": "321", "status": {"display": "OK"}})
+        self.assertEqual(7, r["sequence"])
+
     def test_N1(self):
         r = self.response.N1("123", "456", "789")
         self.assertTrue(isinstance(r, dict))
@@ -145,6 +352,18 @@ class TestProtocol(CustomTestCase):
         r = self.response.N2("123", "456", "789")
         self.assertTrue(isinstance(r, dict))
 
+    def test_N6(self):
+        r = self.response.N6("123", "456", ["789"])
+        self.assertEqual(["789"], r["message_ids"])
+
+    def test_N7(self):
+        r = self.response.N7("123", "456", ["789"])
+        self.assertEqual(["789"], r["message_ids"])
+
+    def test_N8(self):
+        r = self.response.N8("123", "456", "typing")
+        self.assertEqual("typing", r["activity"])
+
     def test_N3_not_valid(self):
         r = self.response.N3("not_valid")
         self.assertTrue(isinstance(r, dict))
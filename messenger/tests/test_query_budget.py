@@ -0,0 +1,150 @@
+from unittest.mock import MagicMock, patch
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from messenger.helpers import get_protocol_contents
+from custom_unittests import CustomTestCase
+from messenger.models import RoomInbox, RoomMessage
+from messenger.presence import Presence
+from messenger.protocol import ProtocolHandlerMixin, Starter, message_response
+from messenger.tests.factories import RoomFactory, RoomMemberFactory
+from custom_auth.factories import CustomUserFactory
+from comms.tests.factories import MessageFactory
+from comms.models import Message
+
+
+@override_settings(RPC_PROTO_SPECS=get_protocol_contents('proto1', path='src/messenger/'))
+class TestQueryBudget(CustomTestCase):
+
+    QUERY_BUDGETS = {
+        "C0_new_room": 12,
+        "C0_existing_room": 4,
+        "C1": 13,
+        "C2": 3,
+        "C3": 3,
+        "C4": 5,
+        "C5": 5,
+        "C6": 1,
+        "init_info": 3,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.me = CustomUserFactory()
+
+    def _room(self, size):
+        room = RoomFactory()
+        users = [self.me] + [CustomUserFactory() for _ in range(size - 1)]
+        for user in users:
+            RoomMemberFactory(user=user, room=room)
+        room.participants = [
+            {"user_id": user.id, "first_name": user.first_name, "last_name": user.last_name}
+            for user in users
+        ]
+        room.refresh_members_key()
+        room.save()
+        return room, users
+
+    def _message(self, room, sender, recipient):
+        message = MessageFactory()
+        message.protocol = Message.WS
+        message.direction = Message.INCOMING
+        message.status = Message.SENT
+        message.context = {"room": room.id}
+        message.sender = sender
+        message.recipient = recipient
+        message.save()
+        return message
+
+    def _count(self, command):
+        protocol = ProtocolHandlerMixin()
+        protocol.me = self.me
+        protocol._message = command
+        protocol.response = message_response
+        protocol.send_json = MagicMock()
+        protocol.channel_layer = MagicMock()
+        with patch('messenger.protocol.async_to_sync') as sync, \
+                patch.object(Presence, 'online_many', return_value=set()), \
+                CaptureQueriesContext(connection) as queries:
+            protocol.process()
+        protocol.send_json.assert_not_called()
+        self.group_sends = [call[0] for call in sync.return_value.call_args_list]
+        return len(queries)
+
+    def _assert_flat(self, name, small, large):
+        self.assertEqual(small, large, "{} query count grows with room size".format(name))
+        self.assertEqual(self.QUERY_BUDGETS[name], large, "{} query budget moved".format(name))
+
+    def test_C0_new_room(self):
+        counts = []
+        for size in (2, 20):
+            users = [CustomUserFactory() for _ in range(size - 1)]
+            counts.append(self._count({"command": "C0", "uids": [user.id for user in users]}))
+        self._assert_flat("C0_new_room", *counts)
+
+    def test_C0_existing_room(self):
+        counts = []
+        for size in (2, 20):
+            _, users = self._room(size)
+            counts.append(self._count({"command": "C0", "uids": [user.id for user in users[1:]]}))
+        self._assert_flat("C0_existing_room", *counts)
+
+    def test_C1(self):
+        counts = []
+        for size in (2, 20):
+            room, users = self._room(size)
+            counts.append(self._count({"command": "C1", "room_id": room.id, "message_data": "hi"}))
+
+            messages = Message.objects.filter(room_link__room=room, sender=self.me)
+            self.assertEqual(
+                {user.id for user in users[1:]},
+                set(messages.values_list("recipient_id", flat=True)),
+            )
+            self.assertEqual(size - 1, RoomMessage.objects.filter(room=room).count())
+            self.assertEqual(1, len(self.group_sends))
+            group, event = self.group_sends[0]
+            self.assertEqual("room_message", event["type"])
+            self.assertEqual("N0", event["message"]["id"])
+            self.assertEqual(room.id, event["message"]["room_id"])
+            self.assertEqual(size - 1, len(event["copies"]))
+        self._assert_flat("C1", *counts)
+
+    def test_C2_C3(self):
+        for command in ("C2", "C3"):
+            counts = []
+            for size in (2, 20):
+                room, users = self._room(size)
+                message = self._message(room, users[1], self.me)
+                counts.append(self._count({"command": command, "message_id": message.id}))
+            self._assert_flat(command, *counts)
+
+    def test_C4_C5(self):
+        for command in ("C4", "C5"):
+            counts = []
+            for size in (2, 20):
+                room, users = self._room(size)
+                message_ids = [self._message(room, user, self.me).id for user in users[1:]]
+                counts.append(self._count({"command": command, "message_ids": message_ids}))
+            self._assert_flat(command, *counts)
+
+    def test_C6(self):
+        counts = []
+        for size in (2, 20):
+            room, _ = self._room(size)
+            counts.append(self._count({"command": "C6", "room_id": room.id, "activity": "typing"}))
+        self._assert_flat("C6", *counts)
+
+    def test_init_info(self):
+        counts = []
+        for rooms in (1, 10):
+            for _ in range(rooms):
+                room, users = self._room(3)
+                message = self._message(room, users[1], self.me)
+                RoomInbox.objects.update_or_create(
+                    user=self.me, room=room,
+                    defaults={"last_message": message, "last_activity": message.created_on}
+                )
+            with CaptureQueriesContext(connection) as queries:
+                Starter.get_initial_info(self.me)
+            counts.append(len(queries))
+        self._assert_flat("init_info", *counts)
@@ -0,0 +1,51 @@
+from unittest.mock import patch
+from django.test import override_settings
+from messenger.helpers import get_protocol_contents
+from custom_unittests import CustomTestCase
+from custom_auth.factories import CustomUserFactory
+from comms.tests.factories import MessageFactory
+from comms.models import Message
+from messenger.protocol import message_response
+from messenger.receipts import Receipt, ReceiptBuffer
+
+
+@override_settings(RPC_PROTO_SPECS=get_protocol_contents('proto1', path='src/messenger/'))
+class TestReceiptBuffer(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.buffer = ReceiptBuffer(message_response, max_size=100, interval=60)
+        self.sender = CustomUserFactory()
+        self.recipient = CustomUserFactory()
+        self.message = MessageFactory()
+        self.message.status = Message.SENT
+        self.message.sender = self.sender
+        self.message.recipient = self.recipient
+        self.message.context = {"room": "abc"}
+        self.message.save()
+
+    def _receipt(self, status):
+        return Receipt(self.message.id, status, self.sender.id, self.recipient.id, "abc")
+
+    def test_keeps_only_forward_transitions(self):
+        self.buffer.add(self._receipt(Message.READ))
+        self.buffer.add(self._receipt(Message.RECEIVED))
+        self.assertEqual(Message.READ, self.buffer._pending[self.message.id].status)
+
+    @patch('messenger.receipts.get_channel_layer')
+    def test_flush_writes_and_notifies_once(self, get_channel_layer):
+        self.buffer.add(self._receipt(Message.RECEIVED))
+        self.buffer.add(self._receipt(Message.READ))
+        with patch('messenger.receipts.async_to_sync') as async_to_sync:
+            self.buffer.flush()
+
+        self.message.refresh_from_db()
+        self.assertEqual(Message.READ, self.message.status)
+        self.assertEqual(1, async_to_sync.return_value.call_count)
+        self.assertEqual({}, self.buffer._pending)
+
+    def test_failed_flush_requeues(self):
+        self.buffer.add(self._receipt(Message.READ))
+        with patch.object(ReceiptBuffer, '_write', side_effect=Exception("db down")):
+            self.buffer.flush()
+        self.assertIn(self.message.id, self.buffer._pending)
@@ -0,0 +1,68 @@
+from unittest.mock import patch
+from django.test import override_settings
+from custom_unittests import CustomTestCase
+from fakeredis import FakeServer, FakeStrictRedis
+from messenger.presence import Presence
+from messenger.sharding import HashRing
+
+SHARD_URLS = [
+    "redis://shard-0:6379",
+    "redis://shard-1:6379",
+    "redis://shard-2:6379",
+]
+
+
+class TestHashRing(CustomTestCase):
+
+    def test_single_node(self):
+        self.assertEqual(0, HashRing(["redis://one"]).index_for("user"))
+
+    def test_keys_spread_across_nodes(self):
+        ring = HashRing(SHARD_URLS)
+        shards = ring.partition(range(3000))
+        self.assertEqual({0, 1, 2}, set(shards))
+        for keys in shards.values():
+            self.assertGreater(len(keys), 600)
+
+    def test_adding_a_node_moves_few_keys(self):
+        before = HashRing(SHARD_URLS)
+        after = HashRing(SHARD_URLS + ["redis://shard-3:6379"])
+        moved = [key for key in range(3000) if before.index_for(key) != after.index_for(key)]
+        self.assertLess(len(moved), 1200)
+        self.assertTrue(all(after.index_for(key) == 3 for key in moved))
+
+
+@override_settings(PRESENCE_REDIS_URLS=SHARD_URLS, PRESENCE_CACHE_ENABLED=False)
+class TestShardedPresence(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.servers = [FakeServer() for _ in SHARD_URLS]
+        Presence._pools = None
+        patcher = patch.object(
+            Presence,
+            '_client',
+            side_effect=lambda index: FakeStrictRedis(server=self.servers[index]),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, Presence, '_pools', None)
+
+    def test_keys_are_routed_to_their_shard(self):
+        users = ["sharded_user{}".format(i) for i in range(30)]
+        for user in users:
+            Presence.increment_active_connections(user, "channel." + user)
+
+        for user in users:
+            shard = FakeStrictRedis(server=self.servers[Presence._shard(user)])
+            self.assertEqual(1, shard.zcard("presence:" + user))
+        self.assertTrue(
+            all(FakeStrictRedis(server=server).dbsize() > 0 for server in self.servers)
+        )
+
+    def test_online_many_merges_shards(self):
+        users = ["sharded_user{}".format(i) for i in range(30)]
+        for user in users[:20]:
+            Presence.increment_active_connections(user, "channel." + user)
+        Presence.decrement_active_connections(users[0], "channel." + users[0])
+        self.assertEqual(set(users[1:20]), Presence.online_many(users))
@@ -0,0 +1,155 @@
+import importlib
+from unittest.mock import MagicMock
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+from custom_unittests import CustomTestCase
+from messenger import consumers, routing
+from messenger.instrumentation import metrics
+from messenger.throttling import (
+    COALESCE,
+    DROP,
+    ActivityThrottle,
+    OutboundBuffer,
+    RateLimiter,
+    TokenBucket,
+    coalesce_key,
+    frame_command,
+)
+
+
+class TestTokenBucket(CustomTestCase):
+
+    def test_refills_at_rate(self):
+        bucket = TokenBucket(rate=2, burst=2)
+        now = bucket.updated
+        self.assertTrue(bucket.consume(now=now))
+        self.assertTrue(bucket.consume(now=now))
+        self.assertFalse(bucket.consume(now=now))
+        self.assertTrue(bucket.consume(now=now + 0.5))
+
+    def test_never_exceeds_burst(self):
+        bucket = TokenBucket(rate=100, burst=3)
+        bucket.consume(now=bucket.updated + 60)
+        self.assertEqual(2, bucket.tokens)
+
+
+@override_settings(MESSENGER_METRICS=True)
+class TestRateLimiter(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics().clear()
+        self.limiter = RateLimiter(
+            user_rate=0, user_burst=3, connection_rate=0, connection_burst=2,
+            costs={"C0": 2}, max_users=10,
+        )
+
+    def test_connection_limit(self):
+        bucket = self.limiter.connection_bucket()
+        self.assertTrue(self.limiter.allow(1, bucket, "C1"))
+        self.assertTrue(self.limiter.allow(1, bucket, "C1"))
+        self.assertFalse(self.limiter.allow(1, bucket, "C1"))
+        self.assertIn(
+            'messenger_rate_limited_total{command="C1",scope="connection"} 1',
+            metrics().render(),
+        )
+
+    def test_user_limit_spans_connections(self):
+        first = self.limiter.connection_bucket()
+        second = self.limiter.connection_bucket()
+        self.assertTrue(self.limiter.allow(1, first, "C0"))
+        self.assertFalse(self.limiter.allow(1, second, "C0"))
+        self.assertTrue(self.limiter.allow(2, second, "C1"))
+        self.assertIn(
+            'messenger_rate_limited_total{command="C0",scope="user"} 1',
+            metrics().render(),
+        )
+
+    def test_rejected_user_frame_keeps_connection_tokens(self):
+        first = self.limiter.connection_bucket()
+        second = self.limiter.connection_bucket()
+        self.limiter.allow(1, first, "C0")
+        self.assertFalse(self.limiter.allow(1, second, "C0"))
+        self.assertEqual(2, second.tokens)
+
+    def test_frame_command(self):
+        self.assertEqual("C1", frame_command({"command": "C1"}))
+        self.assertEqual("invalid", frame_command({"command": "DROP TABLE"}))
+        self.assertEqual("invalid", frame_command({"non": "valid"}))
+        self.assertEqual("invalid", frame_command(["C1"]))
+
+
+class TestOutboundBuffer(CustomTestCase):
+
+    def test_drop_rejects_when_full(self):
+        buffer = OutboundBuffer(max_size=2, policy=DROP)
+        self.assertTrue(buffer.push("a", ("N4", 1)))
+        self.assertTrue(buffer.push("b", ("N4", 1)))
+        self.assertFalse(buffer.push("c"))
+        self.assertEqual(["a", "b", None], [buffer.pop(), buffer.pop(), buffer.pop()])
+
+    def test_coalesce_replaces_pending_frame(self):
+        buffer = OutboundBuffer(max_size=2, policy=COALESCE)
+        buffer.push("delivered", ("receipt", 7))
+        buffer.push("message")
+        self.assertTrue(buffer.push("read", ("receipt", 7)))
+        self.assertFalse(buffer.push("other"))
+        self.assertEqual(["read", "message"], [buffer.pop(), buffer.pop()])
+
+    def test_coalesce_key(self):
+        self.assertEqual(("N4", "r"), coalesce_key({"id": "N4", "room_id": "r"}))
+        self.assertEqual(("receipt", 3), coalesce_key({"id": "N2", "message_id": 3}))
+        self.assertIsNone(coalesce_key({"id": "N6", "message_ids": [3]}))
+
+    def test_requires_async_consumer(self):
+        self.addCleanup(importlib.reload, routing)
+        with override_settings(MESSENGER_OUTBOUND_BUFFER=10):
+            with self.assertRaises(ImproperlyConfigured):
+                importlib.reload(routing)
+        with override_settings(
+            MESSENGER_OUTBOUND_BUFFER=10, MESSENGER_ASYNC_CONSUMER=True
+        ):
+            importlib.reload(routing)
+            self.assertIs(consumers.AsyncRPCConsumer, routing.RPC_CONSUMER)
+
+
+class TestActivityThrottle(CustomTestCase):
+
+    def test_repeats_are_suppressed_within_window(self):
+        throttle = ActivityThrottle(window=3, max_size=10)
+        self.assertTrue(throttle.allow(1, "room", "typing", now=100))
+        self.assertFalse(throttle.allow(1, "room", "typing", now=102))
+        self.assertTrue(throttle.allow(2, "room", "typing", now=102))
+        self.assertTrue(throttle.allow(1, "room", "typing", now=103))
+
+    def test_state_changes_pass(self):
+        throttle = ActivityThrottle(window=3, max_size=10)
+        self.assertTrue(throttle.allow(1, "room", "typing", now=100))
+        self.assertTrue(throttle.allow(1, "room", "paused", now=101))
+        self.assertTrue(throttle.allow(1, "room", "typing", now=102))
+        self.assertFalse(throttle.allow(1, "room", "typing", now=102.5))
+
+    def test_suppressed_repeat_is_sent_on_trailing_edge(self):
+        throttle = ActivityThrottle(window=3, max_size=10)
+        schedule = MagicMock()
+        throttle.allow(1, "room", "typing", schedule, now=100)
+        self.assertFalse(throttle.allow(1, "room", "typing", schedule, now=101))
+        self.assertFalse(throttle.allow(1, "room", "typing", schedule, now=102))
+        schedule.assert_called_once_with(2)
+
+        self.assertEqual("typing", throttle.trailing(1, "room", now=103))
+        self.assertIsNone(throttle.trailing(1, "room", now=103))
+        self.assertFalse(throttle.allow(1, "room", "typing", schedule, now=104))
+
+    def test_state_change_cancels_trailing_edge(self):
+        throttle = ActivityThrottle(window=3, max_size=10)
+        throttle.allow(1, "room", "typing", MagicMock(), now=100)
+        throttle.allow(1, "room", "typing", MagicMock(), now=101)
+        self.assertTrue(throttle.allow(1, "room", "paused", now=102))
+        self.assertIsNone(throttle.trailing(1, "room", now=103))
+
+    def test_bounded_size(self):
+        throttle = ActivityThrottle(window=3, max_size=2)
+        for user_id in range(5):
+            throttle.allow(user_id, "room", "typing", now=100)
+        self.assertEqual(2, len(throttle._sent))
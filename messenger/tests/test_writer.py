@@ -0,0 +1,113 @@
+from unittest.mock import patch
+from django.db import DatabaseError
+from django.test import override_settings
+from messenger.helpers import get_protocol_contents
+from custom_unittests import CustomTestCase
+from messenger.models import Room, RoomInbox, RoomMessage
+from messenger.protocol import ProtocolHandlerMixin
+from messenger.tests.factories import RoomFactory, RoomMemberFactory
+from messenger.writer import MessageWriter
+from custom_auth.factories import CustomUserFactory
+from comms.models import Message
+
+
+@override_settings(RPC_PROTO_SPECS=get_protocol_contents('proto1', path='src/messenger/'))
+class TestMessageWriter(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.room = RoomFactory()
+        self.user = CustomUserFactory()
+        self.user1 = CustomUserFactory()
+        for user in (self.user, self.user1):
+            RoomMemberFactory(user=user, room=self.room)
+            RoomInbox.objects.create(user=user, room=self.room)
+        self.protocol = ProtocolHandlerMixin()
+        self.protocol.me = self.user
+        self.protocol._message = {"command": "C1", "room_id": self.room.id, "message_data": "hi"}
+        self.writer = MessageWriter(max_size=100, batch_size=100, interval=60, max_attempts=2)
+        patcher = patch('messenger.protocol.message_writer', return_value=self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _send(self):
+        messages = self.protocol._write_behind([self.user1.id])
+        if messages is None:
+            self.skipTest("Message ids are assigned by the database")
+        return messages
+
+    def test_messages_are_written_on_flush(self):
+        first = self._send()
+        second = self._send()
+        self.assertFalse(Message.objects.filter(id=first[0].id).exists())
+
+        self.writer.flush()
+
+        self.assertEqual(2, RoomMessage.objects.filter(room=self.room).count())
+        self.assertEqual(first[0].id, Message.objects.get(id=second[0].id).previous_id)
+        self.room.refresh_from_db()
+        self.assertEqual(second[0].id, self.room.last_message_id)
+        self.assertEqual(2, self.room.sequence)
+        inbox = RoomInbox.objects.get(user=self.user1, room=self.room)
+        self.assertEqual(second[0].id, inbox.last_message_id)
+
+    def test_full_queue_flushes_in_order(self):
+        self.writer.max_size = 1
+        first = self._send()
+        second = self._send()
+        self.assertTrue(Message.objects.filter(id=first[0].id).exists())
+        self.assertEqual(1, len(self.writer))
+
+        self.writer.flush()
+
+        self.assertEqual(first[0].id, Message.objects.get(id=second[0].id).previous_id)
+
+    def test_poisoned_send_is_dead_lettered(self):
+        first = self._send()
+        poisoned = self._send()
+        write = self.writer._write
+
+        def failing_write(sends):
+            if any(send.messages is poisoned for send in sends):
+                raise DatabaseError("poisoned")
+            return write(sends)
+
+        with patch.object(self.writer, '_write', side_effect=failing_write), \
+                self.assertLogs('messenger.writer', 'ERROR') as logs:
+            self.assertFalse(self.writer.flush())
+            self.assertTrue(Message.objects.filter(id=first[0].id).exists())
+            third = self._send()
+            self.assertTrue(self.writer.flush())
+
+        self.assertEqual(0, len(self.writer))
+        self.assertTrue(Message.objects.filter(id=third[0].id).exists())
+        self.assertFalse(Message.objects.filter(id=poisoned[0].id).exists())
+        self.assertTrue(any(str(poisoned[0].id) in line for line in logs.output))
+
+    def test_outage_does_not_count_attempts(self):
+        self._send()
+        with patch.object(self.writer, '_write', side_effect=DatabaseError("down")), \
+                self.assertLogs('messenger.writer', 'ERROR'):
+            for _ in range(3):
+                self.assertFalse(self.writer.flush())
+        self.assertEqual(1, len(self.writer))
+        self.assertTrue(self.writer.flush())
+
+    def test_ack_waits_for_pending_message(self):
+        messages = self._send()
+        self.assertTrue(self.writer.is_pending([messages[0].id]))
+        self.protocol.me = self.user1
+        self.assertEqual(messages[0].id, self.protocol._get_message(messages[0].id).id)
+        self.assertFalse(self.writer.is_pending([messages[0].id]))
+
+    def test_bulk_ack_waits_for_pending_messages(self):
+        messages = self._send()
+        self.protocol.me = self.user1
+        updated = self.protocol._update_messages_status([messages[0].id], Message.READ)
+        self.assertEqual([messages[0].id], [row["id"] for row in updated])
+
+    def test_store_messages_falls_back_when_disabled(self):
+        with patch('messenger.protocol.message_writer', return_value=None):
+            messages = self.protocol._store_messages([self.user1.id])
+        self.assertTrue(Message.objects.filter(id=messages[0].id).exists())
+        self.assertEqual(1, Room.objects.get(id=self.room.id).sequence)
@@ -0,0 +1,80 @@
+import time
+from unittest.mock import patch
+from django.test import override_settings
+from custom_unittests import CustomTestCase
+from custom_auth.factories import CustomUserFactory
+from fakeredis import FakeStrictRedis
+from messenger import ws_token_auth
+from messenger.ws_token_auth import TokenUserCache, token_cache
+
+
+class TestTokenUserCache(CustomTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.redis = FakeStrictRedis(decode_responses=True)
+        self.cache = TokenUserCache(
+            max_size=2, ttl=60, channel="tokens", connect=lambda: self.redis
+        )
+        self.user = CustomUserFactory()
+        self.token = "header.payload.signature"
+
+    def test_hit(self):
+        self.cache.set(self.token, self.user)
+        self.assertEqual(self.user, self.cache.get(self.token))
+
+    def test_same_signature_different_token_misses(self):
+        self.cache.set(self.token, self.user)
+        self.assertIsNone(self.cache.get("header.forged.signature"))
+
+    def test_capped_at_token_expiry(self):
+        self.cache.set(self.token, self.user, token_expiry=time.time() - 1)
+        self.assertIsNone(self.cache.get(self.token))
+
+    def test_bounded_size(self):
+        self.cache.set("a.a.1", self.user)
+        self.cache.set("a.a.2", self.user)
+        self.cache.set("a.a.3", self.user)
+        self.assertIsNone(self.cache.get("a.a.1"))
+        self.assertEqual(self.user, self.cache.get("a.a.3"))
+
+    def test_invalidate(self):
+        self.cache.set(self.token, self.user)
+        self.cache.invalidate(str(self.user.pk))
+        self.assertIsNone(self.cache.get(self.token))
+
+    def test_delete_publishes_to_other_processes(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe("tokens")
+        self.cache.set(self.token, self.user)
+        self.cache.delete(self.user.pk)
+        self.assertIsNone(self.cache.get(self.token))
+        self.assertEqual(str(self.user.pk), pubsub.get_message(timeout=1)["data"])
+
+    def _subscribed(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe("tokens")
+        return pubsub
+
+    @override_settings(MESSENGER_TOKEN_CACHE=True)
+    def test_user_save_invalidates_shared_cache(self):
+        with patch.object(ws_token_auth, "_cache", None), patch(
+            "messenger.ws_token_auth.InvalidationListener"
+        ), patch("messenger.ws_token_auth._connect", return_value=self.redis):
+            token_cache().set(self.token, self.user)
+            self.user.is_active = False
+            self.user.save()
+            self.assertIsNone(token_cache().get(self.token))
+
+    @override_settings(MESSENGER_TOKEN_CACHE=True)
+    def test_unrelated_user_save_does_not_publish(self):
+        pubsub = self._subscribed()
+        with patch("messenger.ws_token_auth._connect", return_value=self.redis):
+            self.user.first_name = "Renamed"
+            self.user.save()
+            self.assertIsNone(pubsub.get_message(timeout=0.1))
+            self.user.delete()
+        self.assertIsNotNone(pubsub.get_message(timeout=1))
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(token_cache())
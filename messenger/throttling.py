@@ -0,0 +1,202 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from messenger.instrumentation import increment
+
+DROP = "drop"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+COMMANDS = ("C0", "C1", "C2", "C3", "C4", "C5", "C6")
+INVALID = "invalid"
+
+
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def consume(self, cost=1, now=None):
+        if self.refill(now) < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter(object):
+    def __init__(self, user_rate, user_burst, connection_rate, connection_burst,
+                 costs, max_users):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst
+        self.costs = costs
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def connection_bucket(self):
+        return TokenBucket(self.connection_rate, self.connection_burst)
+
+    def allow(self, user_id, connection_bucket, command):
+        cost = self.costs.get(command, 1)
+        with self._lock:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+            if connection_bucket.refill() < cost:
+                scope = "connection"
+            elif bucket.refill() < cost:
+                scope = "user"
+            else:
+                connection_bucket.tokens -= cost
+                bucket.tokens -= cost
+                return True
+        increment("messenger_rate_limited_total", scope=scope, command=command)
+        return False
+
+
+class OutboundBuffer(object):
+    def __init__(self, max_size, policy):
+        self.max_size = max_size
+        self.policy = policy
+        self._frames = OrderedDict()
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, frame, key=None):
+        if self.policy != COALESCE or key is None:
+            key = next(self._sequence)
+        elif key in self._frames:
+            self._frames[key] = frame
+            increment("messenger_outbound_coalesced_total")
+            return True
+        if len(self._frames) >= self.max_size:
+            increment("messenger_outbound_overflow_total", policy=self.policy)
+            return False
+        self._frames[key] = frame
+        return True
+
+    def pop(self):
+        if not self._frames:
+            return None
+        return self._frames.popitem(last=False)[1]
+
+
+class ActivityThrottle(object):
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._sent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, user_id, room_id, activity, schedule=None, now=None):
+        now = time.monotonic() if now is None else now
+        key = (user_id, str(room_id))
+        with self._lock:
+            entry = self._sent.get(key)
+            if entry is None or entry[0] != activity or now - entry[1] >= self.window:
+                self._sent[key] = [activity, now, False]
+                self._sent.move_to_end(key)
+                while len(self._sent) > self.max_size:
+                    self._sent.popitem(last=False)
+                return True
+            increment("messenger_activity_coalesced_total")
+            if entry[2] or schedule is None:
+                return False
+            entry[2] = True
+            delay = self.window - (now - entry[1])
+        schedule(delay)
+        return False
+
+    def trailing(self, user_id, room_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._sent.get((user_id, str(room_id)))
+            if entry is None or not entry[2]:
+                return None
+            entry[1] = now
+            entry[2] = False
+            return entry[0]
+
+
+def frame_command(frame):
+    command = frame.get("command") if isinstance(frame, dict) else None
+    return command if command in COMMANDS else INVALID
+
+
+def coalesce_key(event):
+    if event.get("id") == "N4":
+        return ("N4", event["room_id"])
+    if event.get("id") in ("N1", "N2"):
+        return ("receipt", event["message_id"])
+    if event.get("id") == "N8":
+        return ("N8", event["room_id"], event["room_member_id"])
+    return None
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def rate_limiter():
+    global _limiter
+    if not getattr(settings, "MESSENGER_RATE_LIMIT", False):
+        return None
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(
+                    user_rate=getattr(settings, "MESSENGER_USER_RATE", 20),
+                    user_burst=getattr(settings, "MESSENGER_USER_BURST", 40),
+                    connection_rate=getattr(settings, "MESSENGER_CONNECTION_RATE", 10),
+                    connection_burst=getattr(settings, "MESSENGER_CONNECTION_BURST", 20),
+                    costs=getattr(settings, "MESSENGER_RATE_LIMIT_COSTS", {"C0": 5}),
+                    max_users=getattr(settings, "MESSENGER_RATE_LIMIT_MAX_USERS", 100000),
+                )
+    return _limiter
+
+
+_activity_throttle = None
+_activity_throttle_lock = threading.Lock()
+
+
+def activity_throttle():
+    global _activity_throttle
+    if _activity_throttle is None:
+        with _activity_throttle_lock:
+            if _activity_throttle is None:
+                _activity_throttle = ActivityThrottle(
+                    window=getattr(settings, "MESSENGER_ACTIVITY_WINDOW", 3),
+                    max_size=getattr(settings, "MESSENGER_ACTIVITY_MAX_SIZE", 100000),
+                )
+    return _activity_throttle
+
+
+def outbound_buffer():
+    max_size = getattr(settings, "MESSENGER_OUTBOUND_BUFFER", None)
+    if not max_size:
+        return None
+    return OutboundBuffer(
+        max_size, getattr(settings, "MESSENGER_OUTBOUND_POLICY", COALESCE)
+    )
@@ -1,7 +1,10 @@
 from django.conf.urls import url
-from .views import InitialInfo
+from .views import InitialInfo, Metrics, RoomHistory, RoomList
 
 
 urlpatterns = [
         url(r'^init_info/', InitialInfo.as_view()),
+        url(r'^rooms/$', RoomList.as_view()),
+        url(r'^rooms/(?P<room_id>[^/]+)/messages/$', RoomHistory.as_view()),
+        url(r'^metrics/$', Metrics.as_view()),
         ]
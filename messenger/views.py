@@ -1,7 +1,18 @@
+import hmac
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse
+from rest_framework.exceptions import NotFound
+from rest_framework.generics import ListAPIView
+from rest_framework.pagination import CursorPagination
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import BasePermission, IsAdminUser, IsAuthenticated
+from messenger.instrumentation import metrics
+from messenger.models import RoomInbox, RoomMember, RoomMessage
 from messenger.protocol import Starter
+from messenger.serializers import RoomInboxSerializer, RoomMessageSerializer
 
 
 class InitialInfo(APIView):
@@ -9,3 +20,66 @@ class InitialInfo(APIView):
 
     def get(self, request, *args, **kwargs):
         return Response(Starter.get_initial_info(request.user))
+
+
+class RoomListPagination(CursorPagination):
+    ordering = "-last_activity"
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+
+class RoomHistoryPagination(CursorPagination):
+    ordering = "-created_on"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+
+class RoomList(ListAPIView):
+    permission_classes = (IsAuthenticated,)
+    serializer_class = RoomInboxSerializer
+    pagination_class = RoomListPagination
+
+    def get_queryset(self):
+        return RoomInbox.objects.filter(
+            user=self.request.user, last_activity__isnull=False
+        ).select_related("room", "last_message__sender", "last_message__recipient")
+
+
+class RoomHistory(ListAPIView):
+    permission_classes = (IsAuthenticated,)
+    serializer_class = RoomMessageSerializer
+    pagination_class = RoomHistoryPagination
+
+    def get_queryset(self):
+        room_id = self.kwargs["room_id"]
+        me = self.request.user
+        if not RoomMember.objects.filter(room_id=room_id, user=me).exists():
+            raise NotFound()
+        return (
+            RoomMessage.objects.filter(room_id=room_id)
+            .filter(Q(recipient=me) | Q(sender=me, primary=True))
+            .select_related("message__sender", "message__recipient")
+        )
+
+
+class HasMetricsToken(BasePermission):
+    def has_permission(self, request, view):
+        token = getattr(settings, "MESSENGER_METRICS_TOKEN", None)
+        if not token:
+            return False
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+        return hmac.compare_digest(header, "Bearer {}".format(token))
+
+
+class Metrics(APIView):
+    permission_classes = (IsAdminUser | HasMetricsToken,)
+
+    def get(self, request, *args, **kwargs):
+        registry = metrics()
+        if registry is None:
+            raise NotFound()
+        return HttpResponse(
+            registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
@@ -0,0 +1,246 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from comms.models import Message
+from messenger.instrumentation import increment, observe
+from messenger.models import Room, RoomInbox, RoomMessage
+
+logger = logging.getLogger(__name__)
+dead_letter_logger = logging.getLogger(__name__ + ".dead_letter")
+
+
+def assign_id(message):
+    field = message._meta.pk
+    if getattr(message, field.attname) is None:
+        setattr(message, field.attname, field.pre_save(message, True))
+    return getattr(message, field.attname) is not None
+
+
+class PendingSend(object):
+    __slots__ = ("room_id", "sequence", "messages", "queued_at", "activity", "attempts")
+
+    def __init__(self, room_id, sequence, messages):
+        self.room_id = room_id
+        self.sequence = sequence
+        self.messages = messages
+        self.queued_at = time.monotonic()
+        self.activity = timezone.now()
+        self.attempts = 0
+
+    def message_ids(self):
+        return [str(message.id) for message in self.messages]
+
+
+class MessageWriter(object):
+    MAX_BACKOFF = 5
+
+    def __init__(self, max_size, batch_size, interval, max_attempts):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self._pending = deque()
+        self._pending_ids = set()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def __len__(self):
+        return self._size
+
+    def is_pending(self, message_ids):
+        with self._lock:
+            return any(str(message_id) in self._pending_ids for message_id in message_ids)
+
+    def submit(self, send):
+        with self._lock:
+            full = self._size >= self.max_size
+        if full:
+            increment("messenger_write_behind_overflow_total")
+            self.flush()
+        with self._lock:
+            self._pending.append(send)
+            self._pending_ids.update(send.message_ids())
+            self._size += len(send.messages)
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="message-writer", daemon=True
+                )
+                self._worker.start()
+            if self._size >= self.batch_size:
+                self._wakeup.set()
+
+    def _run(self):
+        delay = self.interval
+        while True:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            if self.flush():
+                delay = self.interval
+            else:
+                delay = min(delay * 2, self.MAX_BACKOFF)
+            close_old_connections()
+
+    def flush(self):
+        with self._flush_lock:
+            while True:
+                batch = self._take()
+                if not batch:
+                    return True
+                try:
+                    self._commit(batch)
+                    continue
+                except Exception as error:
+                    logger.error(f"Message flush of {len(batch)} sends failed: {error}")
+                failed = self._commit_each(batch)
+                if failed:
+                    with self._lock:
+                        self._pending.extendleft(reversed(failed))
+                        self._size += sum(len(send.messages) for send in failed)
+                    return False
+
+    def _commit_each(self, batch):
+        failed = []
+        errors = {}
+        for send in batch:
+            try:
+                self._commit([send])
+            except Exception as error:
+                failed.append(send)
+                errors[id(send)] = error
+        # When every send fails the database is more likely down than the sends
+        # broken, so only failures next to successful commits count as attempts.
+        if len(failed) == len(batch):
+            return failed
+        retry = []
+        for send in failed:
+            send.attempts += 1
+            if send.attempts < self.max_attempts:
+                retry.append(send)
+            else:
+                self._dead_letter(send, errors[id(send)])
+        return retry
+
+    def _dead_letter(self, send, error):
+        increment("messenger_write_behind_dead_letter_total")
+        with self._lock:
+            self._pending_ids.difference_update(send.message_ids())
+        dead_letter_logger.error(
+            json.dumps(
+                {
+                    "room_id": str(send.room_id),
+                    "sequence": send.sequence,
+                    "message_ids": send.message_ids(),
+                    "sender_id": str(send.messages[0].sender_id),
+                    "recipient_ids": [str(message.recipient_id) for message in send.messages],
+                    "content": send.messages[0].content,
+                    "error": str(error),
+                },
+                default=str,
+            )
+        )
+
+    def _take(self):
+        batch = []
+        count = 0
+        with self._lock:
+            while self._pending and count < self.batch_size:
+                send = self._pending.popleft()
+                batch.append(send)
+                count += len(send.messages)
+            self._size -= count
+        return batch
+
+    def _commit(self, sends):
+        self._write(sends)
+        with self._lock:
+            for send in sends:
+                self._pending_ids.difference_update(send.message_ids())
+        now = time.monotonic()
+        observe(
+            "messenger_write_behind_batch_size",
+            sum(len(send.messages) for send in sends),
+        )
+        for send in sends:
+            observe("messenger_write_behind_lag_seconds", now - send.queued_at)
+
+    def _write(self, sends):
+        by_room = {}
+        for send in sends:
+            by_room.setdefault(str(send.room_id), []).append(send)
+
+        with transaction.atomic():
+            rooms = {
+                str(room.id): room
+                for room in Room.objects.select_for_update().filter(
+                    id__in=[send.room_id for send in sends]
+                )
+            }
+            heads = dict(
+                RoomMessage.objects.filter(
+                    message_id__in=[
+                        room.last_message_id
+                        for room in rooms.values()
+                        if room.last_message_id is not None
+                    ]
+                ).values_list("message_id", "sequence")
+            )
+
+            messages = []
+            advanced = []
+            for key, room_sends in by_room.items():
+                room = rooms.get(key)
+                if room is None:
+                    logger.error(f"Dropping {len(room_sends)} sends to missing room {key}")
+                    continue
+                room_sends.sort(key=lambda send: send.sequence)
+                previous_id = room.last_message_id
+                for send in room_sends:
+                    for message in send.messages:
+                        message.previous_id = previous_id
+                    previous_id = send.messages[-1].id
+                    messages.extend(send.messages)
+                latest = room_sends[-1]
+                if latest.sequence > (heads.get(room.last_message_id) or 0):
+                    advanced.append((room, latest))
+
+            Message.objects.bulk_create(messages)
+            RoomMessage.objects.bulk_create(
+                [RoomMessage.for_message(message) for message in messages]
+            )
+            for room, send in advanced:
+                Room.objects.filter(id=room.id).update(
+                    last_message=send.messages[-1].id, updated_on=timezone.now()
+                )
+                RoomInbox.advance(room.id, send.messages, send.activity)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def message_writer():
+    global _writer
+    if not getattr(settings, "MESSENGER_WRITE_BEHIND", False):
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = MessageWriter(
+                    max_size=getattr(settings, "MESSENGER_WRITE_BEHIND_QUEUE_SIZE", 10000),
+                    batch_size=getattr(settings, "MESSENGER_WRITE_BEHIND_BATCH_SIZE", 500),
+                    interval=getattr(settings, "MESSENGER_WRITE_BEHIND_INTERVAL", 0.05),
+                    max_attempts=getattr(settings, "MESSENGER_WRITE_BEHIND_MAX_ATTEMPTS", 5),
+                )
+                atexit.register(_writer.flush)
+    return _writer
@@ -1,25 +1,171 @@
+import hmac
 import logging
-from django.db import close_old_connections
+import os
+import threading
+import time
+from collections import OrderedDict
+from channels.db import database_sync_to_async
+from django.conf import settings
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 from rest_framework_jwt.utils import jwt_decode_handler
 from django.contrib.auth import get_user_model
+from redis import Redis
+
+from messenger.presence_cache import InvalidationListener
 
 logger = logging.getLogger(__name__)
 
 
+class TokenUserCache(object):
+    def __init__(self, max_size, ttl, channel, connect):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.channel = channel
+        self.connect = connect
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def signature(token):
+        return token.rsplit(".", 1)[-1]
+
+    def get(self, token):
+        signature = self.signature(token)
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is None:
+                return None
+            cached_token, user, expires_at = entry
+            if expires_at <= time.time() or not hmac.compare_digest(cached_token, token):
+                self._discard(signature)
+                return None
+            self._entries.move_to_end(signature)
+            return user
+
+    def set(self, token, user, token_expiry=None):
+        signature = self.signature(token)
+        expires_at = time.time() + self.ttl
+        if token_expiry is not None:
+            expires_at = min(expires_at, token_expiry)
+        with self._lock:
+            self._discard(signature)
+            self._entries[signature] = (token, user, expires_at)
+            self._by_user.setdefault(str(user.pk), set()).add(signature)
+            while len(self._entries) > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, user_pk):
+        with self._lock:
+            for signature in list(self._by_user.get(str(user_pk), ())):
+                self._discard(signature)
+
+    def delete(self, user_pk):
+        self.invalidate(user_pk)
+        try:
+            self.connect().publish(self.channel, user_pk)
+        except Exception as error:
+            logger.error(f"Token invalidation for user {user_pk} failed: {error}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def _discard(self, signature):
+        entry = self._entries.pop(signature, None)
+        if entry is None:
+            return
+        signatures = self._by_user.get(str(entry[1].pk))
+        if signatures is not None:
+            signatures.discard(signature)
+            if not signatures:
+                del self._by_user[str(entry[1].pk)]
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+_redis = None
+
+
+def _connect():
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def token_cache():
+    global _cache, _cache_pid
+    if not getattr(settings, "MESSENGER_TOKEN_CACHE", False):
+        return None
+    pid = os.getpid()
+    if _cache is None or _cache_pid != pid:
+        with _cache_lock:
+            if _cache is None or _cache_pid != pid:
+                _cache_pid = pid
+                _cache = TokenUserCache(
+                    max_size=getattr(settings, "MESSENGER_TOKEN_CACHE_SIZE", 10000),
+                    ttl=getattr(settings, "MESSENGER_TOKEN_CACHE_TTL", 300),
+                    channel=_channel(),
+                    connect=_connect,
+                )
+                InvalidationListener(_connect, _cache.channel, _cache).start()
+    return _cache
+
+
+def _channel():
+    return getattr(settings, "MESSENGER_TOKEN_CHANNEL", "tokens")
+
+
+def invalidate_user_tokens(user_pk):
+    if not getattr(settings, "MESSENGER_TOKEN_CACHE", False):
+        return
+    if _cache is not None and _cache_pid == os.getpid():
+        return _cache.delete(user_pk)
+    try:
+        _connect().publish(_channel(), user_pk)
+    except Exception as error:
+        logger.error(f"Token invalidation for user {user_pk} failed: {error}")
+
+
 class JsonTokenAuthMiddleware(JSONWebTokenAuthentication):
     def __init__(self, inner):
         self.inner = inner
 
     def __call__(self, scope):
+        return JsonTokenAuthMiddlewareInstance(scope, self)
 
-        close_old_connections()
-
+    async def resolve_user(self, scope):
         try:
-            payload = jwt_decode_handler(scope.get("subprotocols")[0])
-            User = get_user_model()
-            scope["user"] = User.objects.get(email=payload.get("email"))
+            token = scope.get("subprotocols")[0]
+            cache = token_cache()
+            user = cache.get(token) if cache is not None else None
+            if user is None:
+                payload = jwt_decode_handler(token)
+                user = await database_sync_to_async(self._get_user)(payload)
+                if cache is not None:
+                    cache.set(token, user, payload.get("exp"))
+            return user
         except Exception as error:
             logger.error(f"WS client connecting with BAD TOKEN: {error}")
+            return None
+
+    @staticmethod
+    def _get_user(payload):
+        User = get_user_model()
+        return User.objects.get(email=payload.get("email"), is_active=True)
+
+
+class JsonTokenAuthMiddlewareInstance(object):
+    def __init__(self, scope, middleware):
+        self.middleware = middleware
+        self.scope = dict(scope)
 
-        return self.inner(scope)
+    async def __call__(self, receive, send):
+        user = await self.middleware.resolve_user(self.scope)
+        if user is not None:
+            self.scope["user"] = user
+        inner = self.middleware.inner(self.scope)
+        return await inner(receive, send)